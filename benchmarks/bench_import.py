@@ -0,0 +1,84 @@
+"""
+Import-time benchmark: how long `import medbot.run` takes in a fresh
+interpreter, i.e. the part of a cold start before the event loop runs.
+
+Runs the import --runs times under `python -X importtime` (without a
+reachable MongoDB, nothing may connect on import), prints the median total
+and the slowest modules as JSON, and exits with 1 when the median exceeds
+--max-ms or when one of the --forbid modules was imported eagerly.
+
+    python benchmarks/bench_import.py --runs 10 --max-ms 800
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", default="medbot.run")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="slowest modules to list")
+    parser.add_argument("--max-ms", type=float, help="fail when the median import time is above")
+    parser.add_argument("--forbid", default="openai,timezonefinder",
+                        help="comma separated modules that must only be imported on first use")
+    parser.add_argument("--out", help="also write the JSON results to this file")
+    return parser.parse_args()
+
+
+def import_once(module: str, forbid: list):
+    """ (total µs, {module: cumulative µs}, forbidden modules imported) of one fresh import """
+    env = dict(os.environ, ENVIRONMENT="bench", MONGODB_STRING="mongodb://127.0.0.1:9/",
+               PYTHONPATH=os.pathsep.join(filter(None, [SRC, os.environ.get("PYTHONPATH")])))
+    code = f"import sys, {module}; print(','.join(m for m in {forbid!r} if m in sys.modules))"
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                          env=env, capture_output=True, text=True, check=True)
+    cumulative = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _self_us, cum, name = (part.strip() for part in line[len("import time:"):].split("|"))
+        cumulative[name] = int(cum)
+    imported = [m for m in proc.stdout.strip().split(",") if m]
+    return cumulative[module], cumulative, imported
+
+
+def main():
+    args = parse_args()
+    forbid = [m.strip() for m in args.forbid.split(",") if m.strip()]
+    totals, runs, imported = [], [], set()
+    for _ in range(args.runs):
+        total, cumulative, forbidden = import_once(args.module, forbid)
+        totals.append(total / 1000)
+        runs.append(cumulative)
+        imported.update(forbidden)
+
+    # modules by median cumulative time, top level packages only to keep it readable
+    names = {name for run in runs for name in run if "." not in name or name.startswith("medbot.")}
+    slowest = sorted(((statistics.median(run.get(name, 0) for run in runs) / 1000, name) for name in names),
+                     reverse=True)[:args.top]
+    results = {
+        "params": vars(args),
+        "import_ms": {"median": statistics.median(totals), "min": min(totals), "max": max(totals)},
+        "slowest_ms": {name: ms for ms, name in slowest},
+        "forbidden_imported": sorted(imported),
+    }
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output)
+
+    failed = bool(imported)
+    if args.max_ms is not None and results["import_ms"]["median"] > args.max_ms:
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
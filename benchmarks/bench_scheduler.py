@@ -0,0 +1,209 @@
+"""
+Scheduler throughput benchmark.
+
+Loads synthetic users and reminders spread over many IANA timezones into an
+in-memory Mongo stand-in (default) or a local MongoDB (--mongo URI, database
+"bench" is dropped and recreated), then runs the reminder pipeline against a
+stub bot and a stub AI gateway with configurable latency. Prints the results
+as JSON (and writes them to --out).
+
+    python benchmarks/bench_scheduler.py --reminders 100000 --due-fraction 0.1
+    python benchmarks/bench_scheduler.py --reminders 1000000 --mongo mongodb://localhost:27017/
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sys
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from zoneinfo import ZoneInfo, available_timezones
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--reminders", type=int, default=10000)
+    parser.add_argument("--reminders-per-user", type=int, default=2)
+    parser.add_argument("--timezones", type=int, default=300, help="distinct IANA timezones")
+    parser.add_argument("--due-fraction", type=float, default=0.1, help="share of reminders due at the tick")
+    parser.add_argument("--mongo", help="MongoDB URI, in-memory stand-in if omitted")
+    parser.add_argument("--send-latency", type=float, default=50, help="stub send_message latency (ms)")
+    parser.add_argument("--ai-latency", type=float, default=500, help="stub completion latency (ms)")
+    parser.add_argument("--rate", type=float, default=1e6, help="global send rate limit (msg/s)")
+    parser.add_argument("--workers", type=int, default=32, help="delivery workers")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="also write the JSON results to this file")
+    return parser.parse_args()
+
+
+args = parse_args()
+# never touch a real environment's database
+os.environ["ENVIRONMENT"] = "bench"
+os.environ["MONGODB_STRING"] = args.mongo or "mongodb://localhost:27017/"
+
+from medbot import ai, jobs, metrics  # noqa: E402
+from medbot.db import db  # noqa: E402
+from medbot.delivery import delivery, TokenBucket  # noqa: E402
+from medbot.outbox import outbox  # noqa: E402
+from medbot.scheduler import scheduler  # noqa: E402
+from medbot.writebehind import writes  # noqa: E402
+from memory_mongo import MemoryClient, RoundTrips  # noqa: E402
+
+
+class StubCompletions:
+    """ Answers like the gateway after a fixed latency, batched prompts get a JSON array """
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = 0
+
+    async def create(self, messages, **_kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        content = messages[-1]["content"]
+        start = content.rfind("\n[")
+        if start >= 0:
+            content = json.dumps([f"Reminder {i} 💊" for i in range(len(json.loads(content[start:])))])
+        else:
+            content = "Reminder 💊"
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+class StubBot:
+    """ send_message with a fixed latency, recording when each message went out """
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.sent_at = []
+
+    async def send_message(self, chat_id, text, **_kwargs):
+        await asyncio.sleep(self.latency)
+        self.sent_at.append(time.perf_counter())
+        return SimpleNamespace(message_id=len(self.sent_at), chat_id=chat_id)
+
+
+def round_trips() -> int:
+    if args.mongo:
+        return sum(sum(series[:-1]) for series in metrics.mongo_seconds.values.values())
+    return RoundTrips.count
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def populate(rng: random.Random):
+    zones = rng.sample(sorted(available_timezones()), min(args.timezones, len(available_timezones())))
+    n_users = max(1, args.reminders // args.reminders_per_user)
+    users = [
+        {'user_id': i, 'first_name': f"User{i}", 'username': f"bench{i}", 'tz': zones[i % len(zones)]}
+        for i in range(1, n_users + 1)
+    ]
+    ai.APPROVED_USERS = {u['username'] for u in users}
+    for i in range(0, len(users), 10000):
+        await db.users.insert_many(users[i:i + 10000])
+
+    now = datetime.now(timezone.utc)
+    batch = []
+    for i in range(args.reminders):
+        user = users[i % n_users]
+        local = now.astimezone(ZoneInfo(user['tz']))
+        if rng.random() < args.due_fraction:
+            # due this minute
+            reminder = {'time': local.strftime("%H:%M"), 'last_sent_date': None}
+        else:
+            # already sent today
+            reminder = {'time': f"{rng.randrange(24):02d}:{rng.randrange(60):02d}", 'last_sent_date': local.date().isoformat()}
+        batch.append({'user_id': user['user_id'], 'tz': user['tz'], 'name': f"pill-{i}", 'confirmed': False, **reminder})
+        if len(batch) >= 10000:
+            await db.reminders.insert_many(batch)
+            batch = []
+    if batch:
+        await db.reminders.insert_many(batch)
+    return n_users
+
+
+async def main():
+    rng = random.Random(args.seed)
+    if args.mongo:
+        db.connect()
+        await db.client.drop_database("bench")
+    else:
+        db.connect(client=MemoryClient())
+
+    results = {"params": vars(args)}
+    t = time.perf_counter()
+    results["users"] = await populate(rng)
+    results["populate_seconds"] = time.perf_counter() - t
+
+    # scheduler start: one pass over all reminders
+    trips = round_trips()
+    t = time.perf_counter()
+    await jobs.start_scheduler(None)
+    results["load_seconds"] = time.perf_counter() - t
+    results["load_round_trips"] = round_trips() - trips
+    results["scheduled"] = len(scheduler)
+
+    # due sweep with nothing missed: one indexed query per timezone
+    trips = round_trips()
+    t = time.perf_counter()
+    await jobs.sweep_due()
+    results["sweep_seconds"] = time.perf_counter() - t
+    results["sweep_round_trips"] = round_trips() - trips
+
+    # pre-generation of the due texts against the stub gateway
+    completions = StubCompletions(args.ai_latency / 1000)
+    ai._client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    ai._semaphore = asyncio.Semaphore(ai.AI_CONCURRENCY)
+    trips = round_trips()
+    t = time.perf_counter()
+    await jobs.pregenerate_job(None)
+    results["pregenerate_seconds"] = time.perf_counter() - t
+    results["pregenerate_round_trips"] = round_trips() - trips
+    results["ai_requests"] = completions.calls
+
+    # one tick with everything due, then wait for the outbox and delivery pool to drain
+    bot = StubBot(args.send_latency / 1000)
+    delivery.workers = args.workers
+    delivery.bucket = TokenBucket(args.rate)
+    delivery.start(bot)
+    outbox.start(delivery)
+    trips = round_trips()
+    tick_start = time.perf_counter()
+    await jobs.reminder_job(None)
+    results["tick_seconds"] = time.perf_counter() - tick_start
+    results["due"] = int(metrics.reminders_due.total())
+    while len(bot.sent_at) < results["due"] and time.perf_counter() - tick_start < 3600:
+        await asyncio.sleep(0.05)
+    # let the last sent callbacks write their updates
+    while delivery.qsize():
+        await asyncio.sleep(0.05)
+    await asyncio.sleep(0.1)
+    await writes.flush()
+    results["drain_seconds"] = time.perf_counter() - tick_start
+    results["tick_round_trips"] = round_trips() - trips
+    results["sent"] = len(bot.sent_at)
+    lags = [sent - tick_start for sent in bot.sent_at]
+    results["delivery_lag_seconds"] = {f"p{int(q * 100)}": percentile(lags, q) for q in (0.5, 0.95, 0.99)}
+    results["outbox"] = {dict(k)['outcome']: v for k, v in metrics.outbox_messages.values.items()}
+    await outbox.stop()
+    await delivery.stop()
+
+    # ru_maxrss is in KiB on Linux
+    results["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output)
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,126 @@
+"""
+In-memory stand-in for pymongo's AsyncMongoClient built on mongomock, so the
+benchmarks run on a plain box without a MongoDB server. Every awaited call
+counts as one round-trip.
+"""
+from types import SimpleNamespace
+
+import mongomock
+from pymongo import InsertOne, UpdateMany, UpdateOne
+
+
+class RoundTrips:
+    count = 0
+
+
+class AsyncCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._it = None
+
+    def sort(self, *args, **kwargs):
+        self._cursor = self._cursor.sort(*args, **kwargs)
+        return self
+
+    def limit(self, n):
+        self._cursor = self._cursor.limit(n)
+        return self
+
+    def batch_size(self, n):
+        self._cursor = self._cursor.batch_size(n)
+        return self
+
+    def __aiter__(self):
+        RoundTrips.count += 1
+        self._it = iter(self._cursor)
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._it)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def close(self):
+        self._cursor.close()
+
+    async def to_list(self, length=None):
+        RoundTrips.count += 1
+        docs = list(self._cursor)
+        return docs[:length] if length else docs
+
+
+class AsyncCollection:
+    def __init__(self, collection):
+        self._collection = collection
+
+    def find(self, *args, **kwargs):
+        return AsyncCursor(self._collection.find(*args, **kwargs))
+
+    async def aggregate(self, pipeline, **_kwargs):
+        RoundTrips.count += 1
+        return AsyncCursor(self._collection.aggregate(pipeline))
+
+    async def bulk_write(self, requests, ordered=True):
+        # mongomock's bulk API does not take pymongo 4's operation objects
+        RoundTrips.count += 1
+        result = SimpleNamespace(inserted_count=0, matched_count=0, modified_count=0, upserted_count=0)
+        for op in requests:
+            if isinstance(op, InsertOne):
+                self._collection.insert_one(op._doc)
+                result.inserted_count += 1
+                continue
+            if isinstance(op, UpdateOne):
+                updated = self._collection.update_one(op._filter, op._doc, upsert=op._upsert)
+            elif isinstance(op, UpdateMany):
+                updated = self._collection.update_many(op._filter, op._doc, upsert=op._upsert)
+            else:
+                raise NotImplementedError(type(op).__name__)
+            result.matched_count += updated.matched_count
+            result.modified_count += updated.modified_count
+            result.upserted_count += updated.upserted_id is not None
+        return result
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if not callable(attr):
+            return attr
+
+        async def call(*args, **kwargs):
+            RoundTrips.count += 1
+            return attr(*args, **kwargs)
+        return call
+
+
+class AsyncDatabase:
+    def __init__(self, database):
+        self._database = database
+
+    def __getitem__(self, name):
+        return AsyncCollection(self._database[name])
+
+    async def list_collection_names(self):
+        return self._database.list_collection_names()
+
+    async def create_collection(self, name, **_kwargs):
+        return AsyncCollection(self._database.create_collection(name))
+
+    async def drop_collection(self, name):
+        self._database.drop_collection(name)
+
+
+class MemoryClient:
+    def __init__(self):
+        self._client = mongomock.MongoClient()
+
+    def __getitem__(self, name):
+        return AsyncDatabase(self._client[name])
+
+    async def server_info(self):
+        return self._client.server_info()
+
+    async def drop_database(self, name):
+        self._client.drop_database(name)
+
+    async def close(self):
+        self._client.close()
@@ -0,0 +1,336 @@
+"""
+Update-replay load harness for the command and callback handlers.
+
+Builds the bot's Application with the same handler registration as run.run(),
+but talking to a local fake Bot API (every call answers after --api-latency)
+and to the in-memory Mongo stand-in (default) or a local MongoDB (--mongo URI,
+database "bench" is dropped and recreated). Generated traffic is a mix of
+/set, /list, /remove, photo replies to reminder messages and remove:
+callbacks from --users seeded users; --replay feeds a recorded stream instead
+(one Telegram Update JSON object per line, --record writes the generated one).
+
+Updates are put on the update queue at --rate per second in bursts of --burst
+and processed with --concurrency concurrent updates. Prints per handler the
+p50/p95/p99 end-to-end latency (enqueue until all handler groups finished) and
+the event-loop blocking time, i.e. the time the handler's coroutine ran
+without yielding to the loop, as JSON (and writes them to --out).
+
+    python benchmarks/replay_load.py --updates 5000 --rate 500 --concurrency 64
+    python benchmarks/replay_load.py --replay updates.jsonl --mongo mongodb://localhost:27017/
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sys
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from zoneinfo import ZoneInfo
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=2000, help="generated updates")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--reminders-per-user", type=int, default=3, help="seeded reminders")
+    parser.add_argument("--mix", default="set=3,list=3,remove=1,photo=2,remove_cb=1",
+                        help="relative weights of the generated update kinds")
+    parser.add_argument("--replay", help="JSONL file of recorded updates to replay instead")
+    parser.add_argument("--record", help="write the generated updates to this JSONL file")
+    parser.add_argument("--rate", type=float, default=200, help="updates per second")
+    parser.add_argument("--burst", type=int, default=1, help="updates enqueued at once")
+    parser.add_argument("--concurrency", type=int, default=32, help="concurrent updates")
+    parser.add_argument("--mongo", help="MongoDB URI, in-memory stand-in if omitted")
+    parser.add_argument("--api-latency", type=float, default=30, help="fake Bot API latency (ms)")
+    parser.add_argument("--ai-latency", type=float, default=0,
+                        help="stub completion latency (ms) for photo rewards, 0 uses the default texts")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="also write the JSON results to this file")
+    return parser.parse_args()
+
+
+args = parse_args()
+# never touch a real environment's database
+os.environ["ENVIRONMENT"] = "bench"
+os.environ["MONGODB_STRING"] = args.mongo or "mongodb://localhost:27017/"
+os.environ.setdefault("LOG_LEVEL", "ERROR")
+
+from telegram import Update  # noqa: E402
+from telegram.ext import ApplicationBuilder, TypeHandler  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+from medbot import ai, run  # noqa: E402
+from medbot.db import db  # noqa: E402
+from medbot.profiling import drive  # noqa: E402
+from memory_mongo import MemoryClient, RoundTrips  # noqa: E402
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': "MedBot", 'username': "medbot_bench_bot"}
+ZONES = ["Europe/Berlin", "America/New_York", "Asia/Tokyo", "Australia/Sydney", "UTC"]
+
+
+class FakeBotAPI(BaseRequest):
+    """ Answers every Bot API method after a fixed latency with a plausible result """
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = Counter()
+        self._message_id = 10 ** 6
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        await asyncio.sleep(self.latency)
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls[endpoint] += 1
+        params = request_data.parameters if request_data else {}
+        if endpoint == "getMe":
+            result = BOT_USER
+        elif endpoint in ("sendMessage", "editMessageText"):
+            self._message_id += 1
+            result = {
+                'message_id': params.get('message_id') or self._message_id,
+                'date': int(time.time()),
+                'chat': {'id': params.get('chat_id') or 0, 'type': "private"},
+                'from': BOT_USER,
+                'text': params.get('text', ""),
+            }
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+class StubCompletions:
+    """ Answers like the gateway after a fixed latency, batched prompts get a JSON array """
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    async def create(self, messages, stream=False, **_kwargs):
+        if stream:
+            return self._stream()
+        await asyncio.sleep(self.latency)
+        content = messages[-1]["content"]
+        start = content.rfind("\n[")
+        if start >= 0:
+            content = json.dumps(["Well done 🎉"] * len(json.loads(content[start:])))
+        else:
+            content = "Well done 🎉"
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+    async def _stream(self, chunks: int = 10):
+        # the whole completion takes the latency, in evenly spaced chunks
+        for i in range(chunks):
+            await asyncio.sleep(self.latency / chunks)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=f"Well done {i} "))])
+
+
+class HandlerStats:
+    """ Per handler wall time, loop blocking time and errors, per update the completion time """
+
+    def __init__(self):
+        self.blocking = defaultdict(list)
+        self.wall = defaultdict(list)
+        self.errors = Counter()
+        self.handler_of = {}
+        self.enqueued = {}
+        self.latency = defaultdict(list)
+
+    def wrap(self, handler):
+        callback = handler.callback
+        name = callback.__qualname__
+
+        async def timed(update, context):
+            self.handler_of[update.update_id] = name
+            start = time.perf_counter()
+            try:
+                return await self.drive(callback(update, context), name)
+            except Exception:
+                self.errors[name] += 1
+                raise
+            finally:
+                self.wall[name].append(time.perf_counter() - start)
+
+        handler.callback = timed
+
+    async def drive(self, coro, name):
+        return await drive(coro, self.blocking[name].append)
+
+    async def done(self, update, _context):
+        """ Runs in the last handler group, after the handler of the update finished """
+        start = self.enqueued.pop(update.update_id, None)
+        if start is not None:
+            name = self.handler_of.pop(update.update_id, "unhandled")
+            self.latency[name].append(time.perf_counter() - start)
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def quantiles(values, scale=1000):
+    result = {f"p{int(q * 100)}": percentile(values, q) for q in (0.5, 0.95, 0.99)}
+    result = {k: v * scale for k, v in result.items() if v is not None}
+    result["max"] = max(values) * scale if values else None
+    return result
+
+
+async def populate(rng: random.Random):
+    """ Users with a timezone, each with reminders already sent today (photo replies confirm them) """
+    now = datetime.now(timezone.utc)
+    users, reminders = [], []
+    for i in range(1, args.users + 1):
+        tz = ZONES[i % len(ZONES)]
+        users.append({'user_id': i, 'first_name': f"User{i}", 'username': f"bench{i}", 'tz': tz})
+        today = now.astimezone(ZoneInfo(tz)).date().isoformat()
+        for j in range(args.reminders_per_user):
+            reminders.append({
+                'user_id': i, 'tz': tz, 'name': f"pill-{j}", 'time': f"{rng.randrange(24):02d}:{rng.randrange(60):02d}",
+                'last_sent_date': today, 'confirmed': False, 'message_id': i * 1000 + j, 'updated_at': now,
+            })
+    await db.users.insert_many(users)
+    await db.reminders.insert_many(reminders)
+    if args.ai_latency:
+        ai.APPROVED_USERS = [u['username'] for u in users]
+        ai._client = SimpleNamespace(chat=SimpleNamespace(completions=StubCompletions(args.ai_latency / 1000)))
+        ai._semaphore = asyncio.Semaphore(ai.AI_CONCURRENCY)
+    return [r['_id'] async for r in db.reminders.find({}, {'_id': 1})]
+
+
+def generate(rng: random.Random, reminder_ids):
+    """ Telegram Update objects (as JSON dicts) for the configured mix """
+    weights = {}
+    for part in args.mix.split(","):
+        kind, weight = part.split("=")
+        weights[kind.strip()] = float(weight)
+    kinds = rng.choices(list(weights), weights=list(weights.values()), k=args.updates)
+    now = int(time.time())
+    updates = []
+    for update_id, kind in enumerate(kinds, start=1):
+        user_id = rng.randrange(1, args.users + 1)
+        user = {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}", 'username': f"bench{user_id}"}
+        message = {'message_id': update_id, 'date': now, 'chat': {'id': user_id, 'type': "private"}, 'from': user}
+        if kind == "remove_cb":
+            # remove:<id> of a random seeded reminder, most belong to somebody else or are gone already
+            data = f"remove:{rng.choice(reminder_ids)}" if rng.random() < 0.9 else "remove:cancel"
+            updates.append({'update_id': update_id, 'callback_query': {
+                'id': str(update_id), 'from': user, 'chat_instance': str(user_id), 'data': data,
+                'message': {**message, 'from': BOT_USER, 'text': "Select a reminder to remove:"},
+            }})
+            continue
+        if kind == "photo":
+            reply_to = user_id * 1000 + rng.randrange(args.reminders_per_user)
+            message['photo'] = [{'file_id': f"p{update_id}", 'file_unique_id': f"u{update_id}", 'width': 90, 'height': 90}]
+            message['reply_to_message'] = {'message_id': reply_to, 'date': now, 'chat': message['chat'],
+                                           'from': BOT_USER, 'text': "Time to take your pill"}
+        else:
+            text = f"/set {rng.randrange(24):02d}:{rng.randrange(60):02d} vitamin {update_id}" if kind == "set" else f"/{kind}"
+            message['text'] = text
+            message['entities'] = [{'type': "bot_command", 'offset': 0, 'length': len(text.split()[0])}]
+        updates.append({'update_id': update_id, 'message': message})
+    return updates
+
+
+async def monitor_loop(lags: list, interval: float = 0.005):
+    """ How late the loop wakes a sleeping task: the latency every other callback sees """
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+async def main():
+    rng = random.Random(args.seed)
+    if args.mongo:
+        db.connect()
+        await db.client.drop_database("bench")
+    else:
+        db.connect(client=MemoryClient())
+    reminder_ids = await populate(rng)
+
+    if args.replay:
+        with open(args.replay) as f:
+            raw_updates = [json.loads(line) for line in f if line.strip()]
+    else:
+        raw_updates = generate(rng, reminder_ids)
+        if args.record:
+            with open(args.record, "w") as f:
+                f.writelines(json.dumps(u) + "\n" for u in raw_updates)
+
+    api = FakeBotAPI(args.api_latency / 1000)
+    app = (ApplicationBuilder().token("123456:bench").request(api).get_updates_request(FakeBotAPI(0))
+           .concurrent_updates(args.concurrency).job_queue(None).build())
+    run.add_handlers(app)
+    stats = HandlerStats()
+    for group in app.handlers.values():
+        for handler in group:
+            stats.wrap(handler)
+    app.add_handler(TypeHandler(Update, stats.done), group=max(app.handlers) + 1)
+
+    await app.initialize()
+    await app.start()
+    updates = [Update.de_json(u, app.bot) for u in raw_updates]
+    lags = []
+    monitor = asyncio.create_task(monitor_loop(lags))
+    trips = RoundTrips.count
+    start = time.perf_counter()
+    for i in range(0, len(updates), args.burst):
+        # keep to the schedule even when enqueueing falls behind
+        delay = start + i / args.rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        for update in updates[i:i + args.burst]:
+            stats.enqueued[update.update_id] = time.perf_counter()
+            await app.update_queue.put(update)
+    while stats.enqueued and time.perf_counter() - start < 3600:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    monitor.cancel()
+    await app.stop()
+    await app.shutdown()
+
+    results = {"params": vars(args), "updates": len(updates), "seconds": elapsed,
+               "throughput": len(updates) / elapsed}
+    if not args.mongo:
+        results["round_trips"] = RoundTrips.count - trips
+    results["bot_api_calls"] = dict(api.calls)
+    results["loop_lag_ms"] = quantiles(lags)
+    results["handlers"] = {
+        name: {
+            "count": len(stats.wall[name]),
+            "errors": stats.errors[name],
+            "latency_ms": quantiles(stats.latency[name]),
+            "wall_ms": quantiles(stats.wall[name]),
+            "blocking_ms": {**quantiles(blocking), "total": sum(blocking) * 1000},
+        }
+        for name, blocking in sorted(stats.blocking.items())
+    }
+    if stats.latency.get("unhandled"):
+        results["unhandled"] = len(stats.latency["unhandled"])
+    # ru_maxrss is in KiB on Linux
+    results["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output)
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
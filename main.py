@@ -1,6 +1,9 @@
 from dotenv import load_dotenv
-from medbot.run import run
+
+# before importing medbot, which reads its settings from the environment at import
+load_dotenv()
+
+from medbot.run import run  # noqa: E402
 
 if __name__ == "__main__":
-    load_dotenv()
     run()
@@ -1,47 +1,233 @@
+import asyncio
+import importlib
+import json
 import logging
 import os
-from openai import OpenAI
+from typing import TYPE_CHECKING, AsyncIterator, Optional
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+from . import metrics
 
 APPROVED_USERS = os.getenv('APPROVED_USERS', '').split(',')
 AI_GATEWAY_API_KEY = os.getenv('AI_GATEWAY_API_KEY')
+AI_TIMEOUT = 20.0  # seconds per completion
+AI_CONCURRENCY = 8  # completions in flight at once
+# prompts arriving within the window are answered by one completion request
+AI_BATCH_WINDOW = 0.05  # seconds
+AI_BATCH_SIZE = 20
 
+_client = None
+_semaphore = None
 
-def get_dynamic_text(prompt: str, user_handle: str, default: str = None) -> str:
-    """Generate dynamic text using AI model based on the prompt."""
-    logger = logging.getLogger(__name__)
-    if user_handle not in APPROVED_USERS:
-        logger.warning("Unauthorized user %s attempted to use AI features.", user_handle)
-        if default:
-            return default
-        return "Unauthorized to use AI features!"
-    try:
-        client = OpenAI(
-            api_key=AI_GATEWAY_API_KEY,
-            base_url='https://ai-gateway.vercel.sh/v1'
-        )
+
+async def _get_client() -> "AsyncOpenAI":
+    """
+    Shared client, its connection pool keeps gateway connections alive between calls.
+    The openai package takes most of the bot's import time, so it is imported on first
+    use and on a worker thread to keep the event loop responsive.
+    """
+    global _client, _semaphore
+    if _client is None:
         if not AI_GATEWAY_API_KEY:
             raise RuntimeError("AI_GATEWAY_API_KEY is not set")
+        openai = await asyncio.to_thread(importlib.import_module, "openai")
+        httpx = importlib.import_module("httpx")
+        if _client is None:
+            _client = openai.AsyncOpenAI(
+                api_key=AI_GATEWAY_API_KEY,
+                base_url='https://ai-gateway.vercel.sh/v1',
+                timeout=AI_TIMEOUT,
+                max_retries=0,
+                http_client=openai.DefaultAsyncHttpxClient(
+                    limits=httpx.Limits(max_connections=AI_CONCURRENCY, max_keepalive_connections=AI_CONCURRENCY)
+                )
+            )
+            _semaphore = asyncio.Semaphore(AI_CONCURRENCY)
+    return _client
+
+
+async def close():
+    """Close the shared client's connections."""
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
+
+
+def is_approved(user_handle: str, warn: bool = True) -> bool:
+    """Whether the user may use AI features, warn about attempts of users who may not."""
+    if user_handle not in APPROVED_USERS:
+        if warn:
+            logging.getLogger(__name__).warning("Unauthorized user %s attempted to use AI features.", user_handle)
+        return False
+    return True
+
+
+async def generate_text(prompt: str, user_handle: str) -> Optional[str]:
+    """Completion for the prompt, None if it could not be generated."""
+    logger = logging.getLogger(__name__)
+    response_text = await _batcher.submit(prompt)
+    if response_text:
+        logger.info("Generated dynamic text for user %s (%d chars)", user_handle, len(response_text))
+        logger.debug("Dynamic text for user %s: %s", user_handle, response_text)
+    return response_text
+
+
+async def stream_text(prompt: str, user_handle: str) -> AsyncIterator[str]:
+    """
+    Completion for the prompt streamed while it is generated, yields the text received so far.
+    Yields nothing for users not approved for AI features or when the completion fails.
+    The stream is read by a task holding the AI slot, so a slow consumer (e.g. one
+    waiting out a Telegram flood limit) does not hold it; it gets the latest text.
+    """
+    metrics.ai_texts.inc(source="stream")
+    if not is_approved(user_handle):
+        return
+    received = {'text': "", 'done': False}
+    changed = asyncio.Event()
+
+    async def read():
+        try:
+            client = await _get_client()
+            async with _semaphore:
+                with metrics.ai_seconds.time():
+                    stream = await client.chat.completions.create(
+                        model="openai/gpt-5-nano",
+                        messages=_messages(prompt),
+                        temperature=0.7,
+                        timeout=AI_TIMEOUT,
+                        stream=True
+                    )
+                    async for chunk in stream:
+                        delta = chunk.choices[0].delta.content if chunk.choices else None
+                        if delta:
+                            received['text'] += delta
+                            changed.set()
+        except Exception as e:
+            logging.getLogger(__name__).error("Error streaming dynamic text: %s", e)
+        finally:
+            received['done'] = True
+            changed.set()
+
+    reader = asyncio.create_task(read())
+    text = ""
+    try:
+        done = False
+        while not done:
+            await changed.wait()
+            changed.clear()
+            # done is read first, the text set before it is then complete
+            done = received['done']
+            if received['text'] != text:
+                text = received['text']
+                yield text
+    finally:
+        # the consumer may stop early
+        reader.cancel()
+    if not text.strip():
+        metrics.ai_fallbacks.inc(source="stream")
+
+
+class PromptBatcher:
+    """
+    Collects prompts for up to window seconds (or max_size prompts) and answers
+    them all with a single completion request returning a JSON array.
+    """
+
+    def __init__(self, window: float = AI_BATCH_WINDOW, max_size: int = AI_BATCH_SIZE):
+        self.window = window
+        self.max_size = max_size
+        self._pending: list = []
+        self._timer = None
+        self._tasks: set = set()
+
+    async def submit(self, prompt: str) -> Optional[str]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((prompt, future))
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: list):
+        prompts = [prompt for prompt, _ in batch]
+        try:
+            if len(prompts) == 1:
+                results = [await _complete(prompts[0])]
+            else:
+                results = _parse_batch(await _complete(_batch_prompt(prompts)), len(prompts))
+        except Exception as e:
+            logging.getLogger(__name__).error("Error generating dynamic text: %s", e)
+            results = [None] * len(prompts)
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+def _batch_prompt(prompts: list) -> str:
+    return (
+        "Write one message for each of the following requests. "
+        "Return only a JSON array of strings, one message per request in the same order, and nothing else.\n\n"
+        + json.dumps(prompts, ensure_ascii=False)
+    )
+
+
+def _parse_batch(response_text: Optional[str], size: int) -> list:
+    """Messages of a batch response, None for every item that could not be parsed."""
+    try:
+        # tolerate a markdown code fence around the array
+        response_text = (response_text or "").strip().removeprefix("```json").strip("`").strip()
+        items = json.loads(response_text)
+    except ValueError:
+        logging.getLogger(__name__).error("Could not parse batched AI response: %s", response_text)
+        return [None] * size
+    if not isinstance(items, list) or len(items) != size:
+        # with a missing or extra message the rest would go to the wrong users
+        logging.getLogger(__name__).error("Batched AI response has %s messages for %d requests",
+                                          len(items) if isinstance(items, list) else "no", size)
+        return [None] * size
+    return [item.strip() if isinstance(item, str) and item.strip() else None for item in items]
+
+
+def _messages(prompt: str) -> list:
+    system_msg = (
+        "You are a friendly, human-like Telegram bot that sends medication reminders everyday. "
+        "Keep the tone warm and easy to understand. "
+        "Only return the message text to be sent to the user — do not include explanations, markup, metadata or any response from user or offering any help via replies."
+    )
+    return [
+        {"role": "system", "content": system_msg},
+        {"role": "user", "content": prompt}
+    ]
+
+
+async def _complete(prompt: str) -> Optional[str]:
+    client = await _get_client()
+
+    async with _semaphore:
+        with metrics.ai_seconds.time():
+            response = await client.chat.completions.create(
+                model="openai/gpt-5-nano",
+                messages=_messages(prompt),
+                temperature=0.7,
+                timeout=AI_TIMEOUT
+            )
+    content = response.choices[0].message.content
+    return content.strip() if content else None
+
 
-        system_msg = (
-            "You are a friendly, human-like Telegram bot that sends medication reminders everyday. "
-            "Keep the tone warm and easy to understand. "
-            "Only return the message text to be sent to the user — do not include explanations, markup, metadata or any response from user or offering any help via replies."
-        )
-        messages = [
-            {"role": "system", "content": system_msg},
-            {"role": "user", "content": prompt}
-        ]
-
-        response = client.chat.completions.create(
-            model="openai/gpt-5-nano",
-            messages=messages,
-            temperature=0.7
-        )
-        response_text = response.choices[0].message.content.strip()
-        logger.info("Generated dynamic text for user %s: %s", user_handle, response_text)
-        return response_text
-    except Exception as e:
-        logger.error("Error generating dynamic text: %s", e)
-        if default:
-            return default
-        return "Sorry, I couldn't process that right now."
+_batcher = PromptBatcher()
@@ -0,0 +1,116 @@
+"""
+Bot identities hosted by this process. Without BOTS_CONFIG there is a single
+one, configured by TELEGRAM_TOKEN, ENVIRONMENT and ADMIN_USER_ID as before.
+BOTS_CONFIG names a YAML file listing several (e.g. one per clinic or language):
+
+    bots:
+      - name: clinic-a
+        token: "123:abc"
+        environment: clinic_a     # database name
+        admin_user_id: 111
+      - name: clinic-b
+        token: "456:def"
+        environment: clinic_b
+        webhook_path: /telegram/b # default /telegram/<name>
+        webhook_secret: "..."     # default WEBHOOK_SECRET
+
+All bots share the Mongo client, the AI client, the timezone finder, the
+reminder scheduler and the delivery pool. Code running for a bot (its
+handlers, or the jobs while they process its reminders) sees it as active(),
+which selects its database and admin.
+"""
+import os
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional
+
+
+@dataclass(frozen=True)
+class BotConfig:
+    name: str
+    token: str
+    environment: str
+    admin_user_id: Optional[int] = None
+    webhook_path: Optional[str] = None
+    webhook_secret: Optional[str] = None
+
+    @property
+    def database(self) -> str:
+        return self.environment.lower()
+
+    def is_admin(self, user_id: int) -> bool:
+        return self.admin_user_id is not None and user_id == self.admin_user_id
+
+
+_current: ContextVar[Optional[BotConfig]] = ContextVar('bot', default=None)
+_hosted: Optional[Dict[str, BotConfig]] = None
+
+
+def from_env() -> BotConfig:
+    """ The single bot configured by environment variables """
+    admin_user_id = os.getenv('ADMIN_USER_ID')
+    return BotConfig(
+        name="default",
+        token=os.getenv('TELEGRAM_TOKEN') or "",
+        environment=os.getenv('ENVIRONMENT') or "",
+        admin_user_id=int(admin_user_id) if admin_user_id else None,
+        webhook_path=os.getenv('WEBHOOK_PATH') or "/telegram",
+        webhook_secret=os.getenv('WEBHOOK_SECRET')
+    )
+
+
+def load(path: str) -> List[BotConfig]:
+    """ Bot configs from a YAML file, see the module docstring """
+    import yaml
+    with open(path) as f:
+        entries = (yaml.safe_load(f) or {}).get('bots') or []
+    configs = []
+    for entry in entries:
+        missing = {'name', 'token', 'environment'} - set(entry)
+        if missing:
+            raise ValueError(f"Bot config {entry.get('name', len(configs))} lacks {', '.join(sorted(missing))}")
+        configs.append(BotConfig(
+            name=str(entry['name']),
+            token=str(entry['token']),
+            environment=str(entry['environment']),
+            admin_user_id=int(entry['admin_user_id']) if entry.get('admin_user_id') else None,
+            webhook_path=entry.get('webhook_path') or f"/telegram/{entry['name']}",
+            webhook_secret=entry.get('webhook_secret') or os.getenv('WEBHOOK_SECRET')
+        ))
+    names = [c.name for c in configs]
+    paths = [c.webhook_path for c in configs]
+    if not configs or len(set(names)) != len(names) or len(set(paths)) != len(paths):
+        raise ValueError(f"{path} must list bots with unique names and webhook paths")
+    return configs
+
+
+def hosted() -> List[BotConfig]:
+    """ All bots of this process, read from BOTS_CONFIG or the environment on first use """
+    global _hosted
+    if _hosted is None:
+        # read here, not at import, so a .env loaded after importing is honoured
+        path = os.getenv('BOTS_CONFIG')
+        configs = load(path) if path else [from_env()]
+        _hosted = {c.name: c for c in configs}
+    return list(_hosted.values())
+
+
+def get(name: str) -> BotConfig:
+    hosted()
+    return _hosted[name]
+
+
+def active() -> BotConfig:
+    """ The bot the running code works for, the first hosted one outside of use() """
+    return _current.get() or hosted()[0]
+
+
+@contextmanager
+def use(config: BotConfig) -> Iterator[BotConfig]:
+    """ Make config the active bot, tasks created inside keep it """
+    token = _current.set(config)
+    try:
+        yield config
+    finally:
+        _current.reset(token)
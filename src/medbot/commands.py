@@ -1,7 +1,6 @@
 import logging
-import os
 from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
-from datetime import datetime
+from datetime import datetime, timezone
 from telegram import (
     Update,
     ReplyKeyboardMarkup,
@@ -11,17 +10,19 @@ from telegram import (
 )
 from telegram.ext import ContextTypes
 
+from . import bots, events
 from .db import db
+from .scheduler import scheduler, load_tz
+from .writebehind import writes
 
 logger = logging.getLogger(__name__)
-ADMIN_USER_ID = os.getenv("ADMIN_USER_ID")
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """ Start command handler """
     # Create a user entry if not exists
     user = update.effective_user
-    db.users.update_one(
+    await db.users.update_one(
         {'user_id': user.id},
         {'$set': {
             'user_id': user.id,
@@ -31,12 +32,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         }},
         upsert=True
     )
+    db.invalidate_user(user.id)
     # Notify admin of new user
-    admin_user_id = os.getenv("ADMIN_USER_ID")
+    admin_user_id = bots.active().admin_user_id
     if admin_user_id:
         try:
             await context.bot.send_message(
-                chat_id=int(admin_user_id),
+                chat_id=admin_user_id,
                 text=f"[INFO] New user started the bot:\n"
                      f"ID: {user.id}\n"
                      f"Name: {user.full_name}\n"
@@ -55,7 +57,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def set_reminder(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """ Set a reminder """
     user_id = update.effective_user.id
-    user = db.get_user(user_id)
+    user = await db.get_user(user_id)
     tz_name = user.get('tz')
 
     if len(context.args) < 2:
@@ -68,13 +70,19 @@ async def set_reminder(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reminder_time = datetime.strptime(context.args[0], "%H:%M").time()
         name = " ".join(context.args[1:]).strip()
         # add a reminder document for this user
-        db.add_reminder({
+        reminder = {
             'user_id': user_id,
             'time': reminder_time.strftime("%H:%M"),
             'name': name,
+            # denormalized from the user for the per-timezone due sweep
+            'tz': tz_name,
             'confirmed': False,
-            'last_sent_date': None
-        })
+            'last_sent_date': None,
+            'updated_at': datetime.now(timezone.utc)
+        }
+        reminder['_id'] = await db.add_reminder(reminder)
+        scheduler.add(reminder, tz_name)
+        await events.reminder_added(reminder)
         await update.message.reply_text(f"Reminder set for '{name}' at {reminder_time.strftime('%H:%M')}")
     except ValueError:
         await update.message.reply_text("Invalid time format. Use HH:MM.")
@@ -88,8 +96,8 @@ async def settz(update: Update, context: ContextTypes.DEFAULT_TYPE):
         tz_name = context.args[0]
         try:
             ZoneInfo(tz_name) # validate via ZoneInfo
-            # upsert tz only
-            db.users.update_one({'user_id': user_id}, {'$set': {'tz': tz_name}}, upsert=True)
+            await db.set_timezone(user_id, tz_name)
+            scheduler.set_timezone(user_id, tz_name)
             await update.message.reply_text(f"Timezone set to {tz_name}")
         except ZoneInfoNotFoundError:
             await update.message.reply_text("Invalid timezone!\nUse an IANA timezone like 'Europe/London'.")
@@ -107,7 +115,9 @@ async def list_reminders(update: Update, _context: ContextTypes.DEFAULT_TYPE):
     """ List reminders command handler """
     user_id = update.effective_user.id
     try:
-        reminders = list(db.get_reminders(user_id))
+        # streaks of recent confirmations may still be buffered
+        await writes.flush()
+        reminders = await db.get_reminders(user_id).to_list()
         if not reminders:
             await update.message.reply_text("No reminders set\nUse /set to add one")
             return
@@ -135,7 +145,7 @@ async def remove_reminder(update: Update, _context: ContextTypes.DEFAULT_TYPE):
     """ Remove reminder command handler """
     user_id = update.effective_user.id
     try:
-        reminders = list(db.get_reminders(user_id))
+        reminders = await db.get_reminders(user_id).to_list()
         if not reminders:
             await update.message.reply_text("No reminders set\nUse /set to add one")
             return
@@ -162,20 +172,35 @@ async def user_stats(update: Update, _context: ContextTypes.DEFAULT_TYPE):
     """ User stats command handler """
     user_id = update.effective_user.id
     try:
-        reminders = list(db.get_reminders(user_id))
+        # rollups maintained by the event log, no scan over the reminders
+        stats = await events.get_stats(user_id)
+        reminders = [r for r in stats.get('reminders', {}).values() if not r.get('removed')]
+        total_reminders = len(reminders)
         if not reminders:
             await update.message.reply_text("No reminders set\nUse /set to add one")
             return
-        total_reminders = len(reminders)
-        longest_streak = max((r.get('streak', 0) for r in reminders), default=0)
-
-        stats_msg = (
-            f"📊 Your Stats:\n"
-            f"Total Reminders: {total_reminders}\n"
-            f"Longest Streak: {longest_streak} day{'s' if longest_streak != 1 else ''} 🔥\n\n"
-            "Keep up the good work! 💪💊"
-        )
-        await update.message.reply_text(stats_msg)
+        longest_streak = stats.get('longest_streak', 0)
+        sent = stats.get('sent', 0)
+        confirmed = stats.get('confirmed', 0)
+        # events are recorded on the user's local day, so is this week
+        profile = (await db.get_profiles([user_id])).get(user_id, {})
+        today = datetime.now(load_tz(profile.get('tz')) or timezone.utc).date()
+        week = stats.get('weekly', {}).get(events.week_key(today), {})
+
+        stats_lines = [
+            "📊 Your Stats:",
+            f"Total Reminders: {total_reminders}",
+        ]
+        if sent:
+            stats_lines.append(f"Adherence: {min(confirmed / sent, 1):.0%} ({confirmed}/{sent} confirmed)")
+        stats_lines.append(f"This Week: {week.get('confirmed', 0)}/{week.get('sent', 0)} confirmed")
+        stats_lines.append(f"Longest Streak: {longest_streak} day{'s' if longest_streak != 1 else ''} 🔥")
+        stats_lines.append("")
+        for r in reminders:
+            streak = r.get('streak', 0)
+            stats_lines.append(f"💊 {r.get('name')}: 🔥 {streak} (best {r.get('longest_streak', 0)})")
+        stats_lines.append("\nKeep up the good work! 💪💊")
+        await update.message.reply_text("\n".join(stats_lines))
 
     except ValueError:
         await update.message.reply_text("Error retrieving user stats")
@@ -193,9 +218,12 @@ async def help_command(update: Update, _context: ContextTypes.DEFAULT_TYPE):
         "/remove - Remove a reminder or all reminders\n"
         "/help - Show this help message"
     )
-    if ADMIN_USER_ID and update.effective_user.id == int(ADMIN_USER_ID):
+    if bots.active().is_admin(update.effective_user.id):
         help_text += "\n\nAdmin commands:\n"
         help_text += "/info - Get my user info\n"
         help_text += "/users - List all users\n"
         help_text += "/sudolist - List reminders for a specific user\n"
+        help_text += "/metrics - Scheduler, delivery, AI and Mongo metrics\n"
+        help_text += "/profile start [ms]|stop|dump [file] - Profile handlers and jobs\n"
+        help_text += "/export users|reminders|events [csv|jsonl] [gz] [user_id] - Export as a file\n"
     await update.message.reply_text(help_text)
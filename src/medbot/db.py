@@ -1,54 +1,175 @@
+import asyncio
 import os
 import logging
-from typing import Iterator, Dict, Any
+from datetime import datetime, timezone
+from typing import Iterable, Dict, Any, List, Optional, Tuple
 import pymongo
-from pymongo.collection import Collection
+from pymongo.asynchronous.collection import AsyncCollection
+from pymongo.asynchronous.cursor import AsyncCursor
+
+from . import bots
+from .cache import TTLCache
+from .metrics import MongoCommandTimer
 
 logger = logging.getLogger(__name__)
 
+# user fields needed to deliver reminders, cached per process
+PROFILE_FIELDS = {'_id': 0, 'user_id': 1, 'tz': 1, 'first_name': 1, 'username': 1}
+PROFILE_CACHE_SIZE = 10000
+PROFILE_CACHE_TTL = 600  # seconds
+# bound on reaching the server at startup instead of pymongo's 30s server selection
+MONGO_CONNECT_TIMEOUT = float(os.getenv('MONGO_CONNECT_TIMEOUT') or 10)
+
+
+class _Collection:
+    """ Collection attribute resolved in the database of the active bot """
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __get__(self, database: "Database", owner=None) -> AsyncCollection:
+        if database is None:
+            return self
+        return database.collection(self.name)
+
+
 class Database:
     """
     Class serving as the main interface to the application.
+    Built on the asyncio pymongo client, every query has to be awaited.
+    The client is created by connect() (or the first ping()) at startup, not on import.
+    One client (and connection pool) serves all hosted bots, the collections
+    are those of the active bot's database (see bots).
     """
     instance = None
 
+    users = _Collection("users")
+    reminders = _Collection("reminders")
+    texts = _Collection("texts")
+    meta = _Collection("meta")
+    events = _Collection("events")
+    stats = _Collection("stats")
+    outbox = _Collection("outbox")
+
     def __init__(self):
         if not Database.instance:
-            self.connect()
+            # keyed on (database, user_id)
+            self.profiles = TTLCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+            self.client = None
+            self._collections: Dict[Tuple[str, str], AsyncCollection] = {}
             Database.instance = self
 
-    def connect(self):
-        """ Connect to database """
-        db_name = f"{os.getenv('ENVIRONMENT').lower()}"
+    def connect(self, client: Any = None):
+        """
+        Create the client, connections are opened lazily on the event loop.
+        A ready client (e.g. an in-memory stand-in for benchmarks) can be passed instead.
+        """
         mongodb_string = os.getenv('MONGODB_STRING')
-        logger.info("Connecting to MongoDB")
-        client = pymongo.MongoClient(
-            mongodb_string
+        self.client = client or pymongo.AsyncMongoClient(
+            mongodb_string,
+            serverSelectionTimeoutMS=int(MONGO_CONNECT_TIMEOUT * 1000),
+            event_listeners=[MongoCommandTimer()]
         )
-        self.db = client[db_name]
+        self._collections.clear()
 
-        # collections
-        self.users: Collection = self.db["users"]
-        self.reminders: Collection = self.db["reminders"]
+    @property
+    def namespace(self) -> str:
+        """ Database name of the active bot """
+        return bots.active().database
 
+    @property
+    def db(self):
+        return self.client[self.namespace]
+
+    def collection(self, name: str, namespace: Optional[str] = None) -> AsyncCollection:
+        """ Collection of the given database, the active bot's by default """
+        key = (namespace or self.namespace, name)
+        collection = self._collections.get(key)
+        if collection is None:
+            collection = self._collections[key] = self.client[key[0]][name]
+        return collection
+
+    @property
+    def connected(self) -> bool:
+        return self.client is not None
+
+    async def ping(self, timeout: float = MONGO_CONNECT_TIMEOUT) -> bool:
+        """ Check that the server is reachable within timeout seconds, connecting first if needed """
+        if not self.connected:
+            self.connect()
+        logger.info("Connecting to MongoDB")
         try:
-            client.server_info()
+            await asyncio.wait_for(self.client.server_info(), timeout)
             logger.info("Connected to MongoDB")
-        except pymongo.errors.ServerSelectionTimeoutError:
-            logger.error("Failed to connect to MongoDB")
+            return True
+        except (pymongo.errors.PyMongoError, asyncio.TimeoutError) as e:
+            logger.error("Failed to connect to MongoDB within %ss: %r", timeout, e)
+            return False
 
     # Convenience helper methods
-    def get_user(self, user_id: int) -> Dict[str, Any]:
-        return self.users.find_one({'user_id': user_id}) or {}
+    async def get_user(self, user_id: int) -> Dict[str, Any]:
+        return await self.users.find_one({'user_id': user_id}) or {}
 
-    def get_users(self) -> Iterator[Dict[str, Any]]:
+    def get_users(self) -> AsyncCursor:
         return self.users.find()
 
-    def add_reminder(self, reminder_data: Dict[str, Any]) -> Any:
-        result = self.reminders.insert_one(reminder_data)
+    async def get_users_page(
+        self,
+        after: Optional[int] = None,
+        before: Optional[int] = None,
+        limit: int = 20,
+        projection: Optional[Dict[str, Any]] = None
+    ) -> Tuple[List[Dict[str, Any]], bool, bool]:
+        """
+        One page of users ordered by user_id (keyset pagination on the user_id index),
+        following after or preceding before. Returns (users, has_prev, has_next).
+        """
+        if before is not None:
+            cursor = self.users.find({'user_id': {'$lt': before}}, projection).sort('user_id', -1)
+            users = await cursor.limit(limit + 1).to_list()
+            has_prev = len(users) > limit
+            return list(reversed(users[:limit])), has_prev, True
+        query = {'user_id': {'$gt': after}} if after is not None else {}
+        users = await self.users.find(query, projection).sort('user_id', 1).limit(limit + 1).to_list()
+        return users[:limit], after is not None, len(users) > limit
+
+    async def get_profiles(self, user_ids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+        """ Cached user profiles (tz, first_name, username), misses fetched with one $in query """
+        namespace = self.namespace
+        profiles = {}
+        missing = []
+        for user_id in set(user_ids):
+            profile = self.profiles.get((namespace, user_id))
+            if profile is None:
+                missing.append(user_id)
+            else:
+                profiles[user_id] = profile
+        if missing:
+            async for user in self.users.find({'user_id': {'$in': missing}}, PROFILE_FIELDS):
+                self.profiles.set((namespace, user['user_id']), user)
+                profiles[user['user_id']] = user
+        return profiles
+
+    def invalidate_user(self, user_id: int):
+        """ Drop the cached profile after the user document was written """
+        self.profiles.pop((self.namespace, user_id))
+
+    async def set_timezone(self, user_id: int, tz_name: str):
+        """ Set the user's timezone, also on the user's reminders (where the due sweep reads it) """
+        now = datetime.now(timezone.utc)
+        await self.users.update_one(
+            {'user_id': user_id},
+            {'$set': {'tz': tz_name, 'updated_at': now}},
+            upsert=True
+        )
+        await self.reminders.update_many({'user_id': user_id}, {'$set': {'tz': tz_name, 'updated_at': now}})
+        self.invalidate_user(user_id)
+
+    async def add_reminder(self, reminder_data: Dict[str, Any]) -> Any:
+        result = await self.reminders.insert_one(reminder_data)
         return result.inserted_id
 
-    def get_reminders(self, user_id: int) -> Iterator[Dict[str, Any]]:
+    def get_reminders(self, user_id: int) -> AsyncCursor:
         return self.reminders.find({'user_id': user_id})
 
 
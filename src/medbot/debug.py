@@ -1,5 +1,9 @@
+import io
 import logging
-from telegram import Update
+import tempfile
+from typing import Optional
+from pymongo.errors import PyMongoError
+from telegram import Message, Update
 from telegram.ext import ContextTypes
 from telegram import (
     Update,
@@ -8,10 +12,21 @@ from telegram import (
     InlineKeyboardButton,
     InlineKeyboardMarkup
 )
+from . import bots, export as exporter, metrics
+from .profiling import profiler
 from .db import db
 
 logger = logging.getLogger(__name__)
 
+# Telegram rejects longer messages and larger uploads
+MAX_MESSAGE_LENGTH = 4096
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024
+
+# users per page of the admin listings
+PAGE_SIZE = 20
+LIST_FIELDS = {'_id': 0, 'user_id': 1, 'username': 1, 'first_name': 1, 'last_name': 1}
+
+
 async def info(update: Update, _context: ContextTypes.DEFAULT_TYPE):
     """ Debug command handler - admin only """
     user_id = update.effective_user.id
@@ -23,17 +38,56 @@ async def info(update: Update, _context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+def is_admin(user_id: int) -> bool:
+    """ Admin of the bot handling the update """
+    return bots.active().is_admin(user_id)
+
+
+def _page_buttons(prefix: str, users, has_prev: bool, has_next: bool) -> list:
+    """ prev/next buttons carrying the keyset bounds of the page """
+    nav = []
+    if users and has_prev:
+        nav.append(InlineKeyboardButton(text="« Prev", callback_data=f"{prefix}:prev:{users[0]['user_id']}"))
+    if users and has_next:
+        nav.append(InlineKeyboardButton(text="Next »", callback_data=f"{prefix}:next:{users[-1]['user_id']}"))
+    return [nav] if nav else []
+
+
+def page_bounds(data: str) -> dict:
+    """ get_users_page arguments from <prefix>:prev|next:<user_id> callback data """
+    _, direction, user_id = data.split(":", 2)
+    return {'before': int(user_id)} if direction == "prev" else {'after': int(user_id)}
+
+
+async def user_list_page(**bounds):
+    """ Text and navigation markup of one /users page """
+    users, has_prev, has_next = await db.get_users_page(limit=PAGE_SIZE, projection=LIST_FIELDS, **bounds)
+    user_count = await db.users.estimated_document_count()
+    user_list_text = "\n".join(
+        [f"@{user.get('username', 'N/A')}\n  ID: {user['user_id']}\n  Name: {user.get('first_name', 'N/A')} {user.get('last_name', '')}" for user in users]
+    )
+    kb = _page_buttons("users", users, has_prev, has_next)
+    return f"[USER LIST] Total Users: {user_count}\n\n{user_list_text}", InlineKeyboardMarkup(kb) if kb else None
+
+
+async def sudo_list_page(**bounds):
+    """ Text and user selection markup of one /sudolist page """
+    users, has_prev, has_next = await db.get_users_page(limit=PAGE_SIZE, projection=LIST_FIELDS, **bounds)
+    kb = []
+    for u in users:
+        uid = str(u.get('user_id'))
+        username = u.get('username')
+        kb.append([InlineKeyboardButton(text=f"@{username}", callback_data=f"sudolist:{uid}")])
+    kb += _page_buttons("sudolist", users, has_prev, has_next)
+    kb.append([InlineKeyboardButton(text="[Cancel]", callback_data="sudolist:cancel")])
+    return "Select a user:", InlineKeyboardMarkup(kb)
+
+
 async def user_list(update: Update, _context: ContextTypes.DEFAULT_TYPE):
     """ List all users command handler - admin only """
     try:
-        users = list(db.get_users())
-        user_count = len(users)
-        user_list_text = "\n".join(
-            [f"@{user.get('username', 'N/A')}\n  ID: {user['user_id']}\n  Name: {user.get('first_name', 'N/A')} {user.get('last_name', '')}" for user in users]
-        )
-        await update.message.reply_text(
-            f"[USER LIST] Total Users: {user_count}\n\n{user_list_text}"
-        )
+        text, markup = await user_list_page()
+        await update.message.reply_text(text, reply_markup=markup)
     except Exception as e:
         logger.error("Failed to retrieve user list: %s", e)
         await update.message.reply_text("Failed to retrieve user list.")
@@ -42,19 +96,112 @@ async def user_list(update: Update, _context: ContextTypes.DEFAULT_TYPE):
 async def sudo_list_reminders(update: Update, _context: ContextTypes.DEFAULT_TYPE):
     """ List reminders command handler """
     try:
-        # give user list of users as keyboard buttons to choose from
-        users = list(db.get_users())
-        kb = []
-        for u in users:
-            uid = str(u.get('user_id'))
-            username = u.get('username')
-            kb.append([InlineKeyboardButton(text=f"@{username}", callback_data=f"sudolist:{uid}")])
-        kb.append([InlineKeyboardButton(text="[Cancel]", callback_data="sudolist:cancel")])
-
-        await update.message.reply_text(
-            "Select a user:",
-            reply_markup=InlineKeyboardMarkup(kb)
-        )
+        # give user list of users as keyboard buttons to choose from, one page at a time
+        text, markup = await sudo_list_page()
+        await update.message.reply_text(text, reply_markup=markup)
 
     except ValueError:
         await update.message.reply_text("Error retrieving users")
+
+
+async def metrics_summary(update: Update, _context: ContextTypes.DEFAULT_TYPE):
+    """ Summary of the operational metrics - admin only """
+    lines = ["[METRICS]"]
+    for name, label, histogram in (
+        ("Reminder tick", None, metrics.tick_seconds),
+        ("Delivery lag", None, metrics.delivery_lag),
+        ("send_message", None, metrics.send_seconds),
+        ("AI completion", None, metrics.ai_seconds),
+    ):
+        count, mean, p50, p95 = histogram.summary()
+        lines.append(f"{name}: n={count} avg={mean:.3f}s p50≤{p50}s p95≤{p95}s")
+    lines.append(f"Reminders scheduled: {metrics.reminders_scheduled.total():.0f}")
+    lines.append(f"Reminders due / scanned: {metrics.reminders_due.total():.0f} / {metrics.reminders_scanned.total():.0f}")
+    lines.append(f"Delivery queue: {metrics.delivery_queue.total():.0f}")
+    lines.append(f"Send errors: {metrics.send_errors.total():.0f}")
+    outcomes = {dict(key).get('outcome'): value for key, value in metrics.outbox_messages.values.items()}
+    lines.append("Outbox: " + ", ".join(f"{outcome} {outcomes.get(outcome, 0):.0f}"
+                                        for outcome in ("enqueued", "duplicate", "sent", "retried", "dead")))
+    texts = metrics.ai_texts.total()
+    fallbacks = metrics.ai_fallbacks.total()
+    lines.append(f"AI fallback rate: {fallbacks / texts:.0%} ({fallbacks:.0f}/{texts:.0f})" if texts else "AI fallback rate: n/a")
+    lines.append("Mongo (count, avg):")
+    for key in sorted(metrics.mongo_seconds.values):
+        count, mean, _, _ = metrics.mongo_seconds.summary(key)
+        lines.append(f"  {dict(key).get('command')}: {count}, {mean * 1000:.1f}ms")
+    await update.message.reply_text("\n".join(lines))
+
+
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """ /profile start [interval ms] | stop | dump [file] - admin only """
+    action = context.args[0].lower() if context.args else "dump"
+    if action == "start":
+        try:
+            interval = float(context.args[1]) / 1000 if len(context.args) > 1 else None
+        except ValueError:
+            await update.message.reply_text("Usage: /profile start [interval ms]")
+            return
+        if profiler.active:
+            await update.message.reply_text("Profiler already running")
+            return
+        profiler.start(interval)
+        await update.message.reply_text(f"Profiler started, sampling every {profiler.interval * 1000:.1f}ms")
+    elif action == "stop":
+        profiler.stop()
+        await update.message.reply_text(profiler.report()[:MAX_MESSAGE_LENGTH])
+    elif action == "dump":
+        if len(context.args) > 1 and context.args[1].lower() == "file":
+            await update.message.reply_document(document=io.BytesIO(profiler.report(top=100).encode()),
+                                                filename="profile.txt")
+            # collapsed stacks for flamegraph.pl or speedscope
+            await update.message.reply_document(document=io.BytesIO(profiler.collapsed().encode() or b"\n"),
+                                                filename="profile.folded")
+        else:
+            await update.message.reply_text(profiler.report()[:MAX_MESSAGE_LENGTH])
+    else:
+        await update.message.reply_text("Usage: /profile start [interval ms] | stop | dump [file]")
+
+
+async def export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """ /export users|reminders|events [csv|jsonl] [gz] [user_id] - admin only """
+    usage = f"Usage: /export {'|'.join(exporter.EXPORTS)} [csv|jsonl] [gz] [user_id]"
+    args = [arg.lower() for arg in context.args or []]
+    if not args or args[0] not in exporter.EXPORTS:
+        await update.message.reply_text(usage)
+        return
+    collection, fmt, compress, user_id = args[0], 'csv', False, None
+    for arg in args[1:]:
+        if arg in exporter.FORMATS:
+            fmt = arg
+        elif arg in ("gz", "gzip"):
+            compress = True
+        elif arg.isdigit():
+            user_id = int(arg)
+        else:
+            await update.message.reply_text(usage)
+            return
+    await update.message.reply_text(f"Exporting {collection}, the file follows when it is done")
+    # in the background, a large export must not hold up other users' updates
+    context.application.create_task(_export(update.message, collection, fmt, compress, user_id), update=update)
+
+
+async def _export(message: Message, collection: str, fmt: str, compress: bool, user_id: Optional[int]):
+    """ Export the collection and reply with the file """
+    # spooled to disk, never more than one batch of documents in memory
+    with tempfile.TemporaryFile() as out:
+        try:
+            count = await exporter.export(out, collection, fmt, compress, exporter.user_query(collection, user_id))
+        except (PyMongoError, OSError) as e:
+            logger.error("Export of %s failed: %s", collection, e)
+            await message.reply_text("Export failed")
+            return
+        size = out.tell()
+        if size > MAX_UPLOAD_BYTES:
+            await message.reply_text(
+                f"Export is {size / 1024 / 1024:.0f} MB, over the upload limit: "
+                f"add gz, or use python -m medbot.export {collection}"
+            )
+            return
+        out.seek(0)
+        filename = f"{collection}.{fmt}" + (".gz" if compress else "")
+        await message.reply_document(document=out, filename=filename, caption=f"{count} {collection}")
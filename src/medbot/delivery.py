@@ -0,0 +1,175 @@
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from datetime import timedelta
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from telegram import Bot, Message
+from telegram.error import RetryAfter
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+DELIVERY_WORKERS = int(os.getenv('DELIVERY_WORKERS') or 8)
+# Telegram allows ~30 messages per second overall and about one per second per chat
+GLOBAL_RATE = 30.0
+CHAT_INTERVAL = 1.0
+
+
+class TokenBucket:
+    """ Global rate limiter: rate tokens per second with bursts up to capacity """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """ Hand out no tokens for the given time (flood control) """
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class ChatLimiter:
+    """ Keeps consecutive messages to the same chat at least interval seconds apart """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._next: Dict[int, float] = {}
+
+    def reserve(self, chat_id: int) -> float:
+        """ Seconds to wait before chat_id may be messaged, reserves the slot if 0 """
+        now = time.monotonic()
+        wait = self._next.get(chat_id, 0.0) - now
+        if wait > 0:
+            return wait
+        self._next[chat_id] = now + self.interval
+        if len(self._next) > 10000:
+            self._next = {c: t for c, t in self._next.items() if t > now}
+        return 0.0
+
+
+@dataclass
+class OutgoingMessage:
+    chat_id: int
+    text: str
+    # awaited with the sent message / the final error
+    on_sent: Optional[Callable[[Message], Awaitable[Any]]] = None
+    on_failed: Optional[Callable[[Exception], Awaitable[Any]]] = None
+    kwargs: Dict[str, Any] = field(default_factory=dict)
+    # sent by this bot instead of the pool's, when several are hosted
+    bot: Optional[Bot] = None
+
+
+class DeliveryPool:
+    """
+    Sends queued messages with a bounded number of concurrent workers, within the
+    global and per-chat Telegram limits. Flood-controlled messages are re-queued.
+    The workers are shared by all hosted bots, the limits apply per bot token.
+    """
+
+    def __init__(self, workers: int = DELIVERY_WORKERS, rate: float = GLOBAL_RATE,
+                 chat_interval: float = CHAT_INTERVAL):
+        self.workers = workers
+        self.bucket = TokenBucket(rate)
+        self.chats = ChatLimiter(chat_interval)
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: list = []
+        self._bot: Optional[Bot] = None
+        # token -> limits of the other hosted bots
+        self._limits: Dict[str, Tuple[TokenBucket, ChatLimiter]] = {}
+
+    def start(self, bot: Bot):
+        self._bot = bot
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker(), name=f"delivery-{i}") for i in range(self.workers)]
+        logger.info("Started %d delivery workers", self.workers)
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._queue and self._queue.qsize():
+            logger.warning("Delivery stopped with %d queued messages", self._queue.qsize())
+
+    def submit(self, message: OutgoingMessage):
+        self._queue.put_nowait(message)
+        metrics.delivery_queue.set(self._queue.qsize())
+
+    def qsize(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    def _requeue(self, message: OutgoingMessage, delay: float):
+        asyncio.get_running_loop().call_later(delay, self._queue.put_nowait, message)
+
+    async def _worker(self):
+        while True:
+            message = await self._queue.get()
+            metrics.delivery_queue.set(self._queue.qsize())
+            try:
+                await self._deliver(message)
+            except Exception as e:
+                logger.error("Unexpected delivery error for chat %s: %s", message.chat_id, e)
+            finally:
+                self._queue.task_done()
+
+    def _limiters(self, bot: Bot) -> Tuple[TokenBucket, ChatLimiter]:
+        if bot is self._bot:
+            return self.bucket, self.chats
+        if bot.token not in self._limits:
+            self._limits[bot.token] = (TokenBucket(self.bucket.rate), ChatLimiter(self.chats.interval))
+        return self._limits[bot.token]
+
+    async def _deliver(self, message: OutgoingMessage):
+        bot = message.bot or self._bot
+        bucket, chats = self._limiters(bot)
+        wait = chats.reserve(message.chat_id)
+        if wait > 0:
+            self._requeue(message, wait)
+            return
+        await bucket.acquire()
+        start = time.perf_counter()
+        try:
+            sent = await bot.send_message(chat_id=message.chat_id, text=message.text, **message.kwargs)
+            metrics.send_seconds.observe(time.perf_counter() - start)
+        except RetryAfter as e:
+            metrics.send_errors.inc(error=type(e).__name__)
+            delay = e.retry_after
+            if isinstance(delay, timedelta):
+                delay = delay.total_seconds()
+            logger.warning("Flood control, retrying chat %s in %ss", message.chat_id, delay)
+            bucket.pause(delay)
+            self._requeue(message, delay)
+            return
+        except Exception as e:
+            metrics.send_errors.inc(error=type(e).__name__)
+            logger.error("Error sending message to %s: %s", message.chat_id, e)
+            if message.on_failed:
+                await message.on_failed(e)
+            return
+        if message.on_sent:
+            await message.on_sent(sent)
+
+
+delivery = DeliveryPool()
@@ -0,0 +1,73 @@
+"""
+Append-only log of reminder deliveries and confirmations (a time-series
+collection) plus per-user rollups that are updated on every event, so /stats
+reads a single precomputed document. Both are written through the write-behind
+buffer.
+"""
+from datetime import date, datetime, timezone
+from typing import Any, Dict, Iterable, Optional
+
+from .db import db
+from .writebehind import writes
+
+SENT = 'sent'
+CONFIRMED = 'confirmed'
+
+
+def week_key(day: date) -> str:
+    year, week, _ = day.isocalendar()
+    return f"{year}-W{week:02d}"
+
+
+def _record(event: str, reminder: Dict[str, Any], day: date, streak: Optional[int] = None):
+    user_id = reminder['user_id']
+    rid = str(reminder['_id'])
+    doc = {
+        'ts': datetime.now(timezone.utc),
+        'meta': {'user_id': user_id, 'reminder_id': reminder['_id'], 'type': event},
+        'date': day.isoformat()
+    }
+    update = {
+        '$inc': {
+            event: 1,
+            f'weekly.{week_key(day)}.{event}': 1,
+            f'reminders.{rid}.{event}': 1
+        },
+        '$set': {f'reminders.{rid}.name': reminder.get('name')}
+    }
+    if streak is not None:
+        doc['streak'] = streak
+        update['$set'][f'reminders.{rid}.streak'] = streak
+        update['$max'] = {'longest_streak': streak, f'reminders.{rid}.longest_streak': streak}
+    writes.insert('events', doc)
+    writes.update('stats', {'_id': user_id}, update, upsert=True)
+
+
+def record_sent(reminder: Dict[str, Any], day: date):
+    """ Reminder was delivered on the user's local date day """
+    _record(SENT, reminder, day)
+
+
+def record_confirmed(reminder: Dict[str, Any], day: date, streak: int):
+    """ Reminder sent on day was confirmed, reaching streak """
+    _record(CONFIRMED, reminder, day, streak)
+
+
+async def reminder_added(reminder: Dict[str, Any]):
+    await db.stats.update_one(
+        {'_id': reminder['user_id']},
+        {'$set': {f"reminders.{reminder['_id']}.name": reminder.get('name')}},
+        upsert=True
+    )
+
+
+async def reminders_removed(user_id: int, reminder_ids: Iterable[Any]):
+    """ Keep the history of removed reminders but no longer list them """
+    removed = {f'reminders.{rid}.removed': True for rid in reminder_ids}
+    if removed:
+        await db.stats.update_one({'_id': user_id}, {'$set': removed}, upsert=True)
+
+
+async def get_stats(user_id: int) -> Dict[str, Any]:
+    await writes.flush()
+    return await db.stats.find_one({'_id': user_id}) or {}
@@ -0,0 +1,167 @@
+"""
+Streaming export of users, reminders and the adherence event log as CSV or
+JSON Lines, optionally gzipped. Documents are read through a cursor in
+batches of EXPORT_BATCH with a projection of the exported fields, and each
+batch is encoded and written before the next one is fetched, so memory stays
+bounded by one batch whatever the collection size.
+
+From the command line (or /export in the bot):
+python -m medbot.export reminders --format jsonl --gzip -o reminders.jsonl.gz
+"""
+import argparse
+import asyncio
+import csv
+import gzip
+import io
+import json
+import logging
+import sys
+from datetime import date, datetime
+from typing import Any, BinaryIO, Dict, List, Optional
+
+from bson import ObjectId
+
+from . import bots, utils
+from .db import db
+
+logger = logging.getLogger(__name__)
+
+EXPORT_BATCH = 1000
+FORMATS = ('csv', 'jsonl')
+# collection -> exported fields, dotted paths are flattened to one column
+EXPORTS: Dict[str, List[str]] = {
+    'users': ['user_id', 'username', 'first_name', 'last_name', 'tz', 'updated_at'],
+    'reminders': ['_id', 'user_id', 'name', 'time', 'tz', 'confirmed', 'last_sent_date',
+                  'last_confirmed_date', 'nconfirmed', 'streak', 'updated_at'],
+    'events': ['ts', 'meta.user_id', 'meta.reminder_id', 'meta.type', 'date', 'streak'],
+}
+# indexed sort keys, the event log is read in its natural order (sorting it would not use an index)
+SORT = {'users': 'user_id', 'reminders': '_id'}
+
+
+def _value(doc: Dict[str, Any], path: str) -> Any:
+    for part in path.split('.'):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(part)
+    return doc
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError(f"Cannot export {type(value).__name__}")
+
+
+class _Encoder:
+    """ Encodes batches of documents to bytes, the CSV header with the first one """
+
+    def __init__(self, fields: List[str], fmt: str):
+        self.fields = fields
+        self.fmt = fmt
+        self._header = fmt == 'csv'
+
+    def encode(self, batch: List[Dict[str, Any]]) -> bytes:
+        buf = io.StringIO()
+        if self.fmt == 'csv':
+            writer = csv.writer(buf)
+            if self._header:
+                writer.writerow(self.fields)
+                self._header = False
+            for doc in batch:
+                writer.writerow([_csv_value(_value(doc, field)) for field in self.fields])
+        else:
+            for doc in batch:
+                buf.write(json.dumps({field: _value(doc, field) for field in self.fields},
+                                     default=_default, ensure_ascii=False))
+                buf.write("\n")
+        return buf.getvalue().encode()
+
+
+def _csv_value(value: Any) -> Any:
+    if value is None:
+        return ""
+    return _default(value) if isinstance(value, (datetime, date, ObjectId)) else value
+
+
+async def export(out: BinaryIO, collection: str, fmt: str = 'csv', compress: bool = False,
+                 query: Optional[Dict[str, Any]] = None, batch_size: int = EXPORT_BATCH) -> int:
+    """ Write the collection to out, returns the number of exported documents """
+    if collection not in EXPORTS:
+        raise ValueError(f"Unknown export {collection}, one of {', '.join(EXPORTS)}")
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format {fmt}, one of {', '.join(FORMATS)}")
+    fields = EXPORTS[collection]
+    projection = {field: 1 for field in fields}
+    if '_id' not in fields:
+        projection['_id'] = 0
+    encoder = _Encoder(fields, fmt)
+    sink = gzip.GzipFile(fileobj=out, mode='wb') if compress else out
+    cursor = getattr(db, collection).find(query or {}, projection).batch_size(batch_size)
+    if collection in SORT:
+        cursor = cursor.sort(SORT[collection], 1)
+    count = 0
+    batch = []
+    try:
+        async for doc in cursor:
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                count += await _write(sink, encoder, batch)
+                batch = []
+        if batch or not count:
+            # an empty CSV export still gets its header
+            count += await _write(sink, encoder, batch)
+    finally:
+        await cursor.close()
+        if compress:
+            await asyncio.to_thread(sink.close)
+    logger.info("Exported %d %s as %s", count, collection, fmt)
+    return count
+
+
+async def _write(sink: BinaryIO, encoder: _Encoder, batch: List[Dict[str, Any]]) -> int:
+    # encoding, compression and file writes run off the event loop
+    await asyncio.to_thread(lambda: sink.write(encoder.encode(batch)))
+    return len(batch)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Export users, reminders or the event log")
+    parser.add_argument("collection", choices=sorted(EXPORTS))
+    parser.add_argument("--format", choices=FORMATS, default='csv')
+    parser.add_argument("--gzip", action="store_true", help="compress the output (default for *.gz files)")
+    parser.add_argument("--user", type=int, help="only this user's documents")
+    parser.add_argument("--bot", help="name of the bot in BOTS_CONFIG (default the first)")
+    parser.add_argument("--batch-size", type=int, default=EXPORT_BATCH)
+    parser.add_argument("-o", "--out", help="output file, stdout if not given")
+    return parser.parse_args(argv)
+
+
+def user_query(collection: str, user_id: Optional[int]) -> Dict[str, Any]:
+    if user_id is None:
+        return {}
+    return {'meta.user_id': user_id} if collection == 'events' else {'user_id': user_id}
+
+
+async def main(argv=None) -> int:
+    args = parse_args(argv)
+    if not await db.ping():
+        return 1
+    compress = args.gzip or bool(args.out and args.out.endswith(".gz"))
+    query = user_query(args.collection, args.user)
+    with bots.use(bots.get(args.bot) if args.bot else bots.active()):
+        if args.out:
+            with open(args.out, "wb") as out:
+                await export(out, args.collection, args.format, compress, query, args.batch_size)
+        else:
+            await export(sys.stdout.buffer, args.collection, args.format, compress, query, args.batch_size)
+            sys.stdout.buffer.flush()
+    return 0
+
+
+if __name__ == "__main__":
+    # stdout may carry the export, log to stderr only
+    utils.setup_logging(stream=sys.stderr)
+    sys.exit(asyncio.run(main()))
@@ -1,18 +1,26 @@
+import asyncio
 import logging
+import time
 from bson import ObjectId
 from datetime import datetime, timedelta
-from telegram import Update, ReplyKeyboardRemove
+from telegram import Message, Update, ReplyKeyboardRemove
+from telegram.error import RetryAfter, TelegramError
 from telegram.ext import ContextTypes
-from timezonefinder import TimezoneFinder
 
-from .ai import get_dynamic_text
+from .ai import is_approved, stream_text
+from . import events
+from . import debug
 from .db import db
-
-# timezone finder instance (cheap to keep around)
-tzfinder = TimezoneFinder()
+from .scheduler import scheduler
+from .tzlookup import tz_resolver
+from .writebehind import writes
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_REWARD = "✅ Good job! You're a nice person! 🎉🏆"
+# edits of a streamed reward message, Telegram allows about one per second per chat
+REWARD_EDIT_INTERVAL = 1.5  # seconds
+
 
 async def handle_location(update: Update, _context: ContextTypes.DEFAULT_TYPE):
     """Handle a location message and map it to an IANA timezone."""
@@ -22,7 +30,7 @@ async def handle_location(update: Update, _context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("No location found in the message.")
         return
     lat, lon = loc.latitude, loc.longitude
-    tz_name = tzfinder.timezone_at(lat=lat, lng=lon)
+    tz_name = await tz_resolver.timezone_at(lat, lon)
 
     if not tz_name:
         logger.warning("Could not determine timezone for location (%f, %f) from user %s", lat, lon, user_id)
@@ -31,8 +39,8 @@ async def handle_location(update: Update, _context: ContextTypes.DEFAULT_TYPE):
             reply_markup=ReplyKeyboardRemove()
         )
         return
-    # Save tz (only update tz field)
-    db.users.update_one({'user_id': user_id}, {'$set': {'tz': tz_name}}, upsert=True)
+    await db.set_timezone(user_id, tz_name)
+    scheduler.set_timezone(user_id, tz_name)
     logger.info("Set timezone for user %s to %s based on location (%f, %f)", user_id, tz_name, lat, lon)
     await update.message.reply_text(
         f"Detected timezone: {tz_name}",
@@ -40,7 +48,7 @@ async def handle_location(update: Update, _context: ContextTypes.DEFAULT_TYPE):
     )
 
 
-async def handle_photo(update: Update, _context: ContextTypes.DEFAULT_TYPE):
+async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle a photo message as confirmation."""
     user_id = update.effective_user.id
     photo_msg_id = update.message.message_id
@@ -48,7 +56,9 @@ async def handle_photo(update: Update, _context: ContextTypes.DEFAULT_TYPE):
     if reply:
         # check if this photo is a reply to a reminder message
         reply_msg_id = reply.message_id
-        r = db.reminders.find_one({'user_id': user_id, 'message_id': reply_msg_id})
+        # message_id and confirmed of recent deliveries may still be buffered
+        await writes.flush()
+        r = await db.reminders.find_one({'user_id': user_id, 'message_id': reply_msg_id})
         if r: # reminder is followed up
             # if already confirmed
             already_confirmed = r.get('confirmed', False)
@@ -73,27 +83,62 @@ async def handle_photo(update: Update, _context: ContextTypes.DEFAULT_TYPE):
                 else:
                     streak = 1  # reset streak
                     logger.info("Streak reset for reminder %s by user %s", r['_id'], user_id)
-            db.reminders.update_one(
+            writes.update(
+                'reminders',
                 {'_id': r['_id']},
                 {'$set': {'confirmed': True, 'nconfirmed': nconfirmed, 'streak': streak, 'last_confirmed_date': confirmed_date_str}}
             )
+            events.record_confirmed(r, datetime.strptime(confirmed_date_str, "%Y-%m-%d").date(), streak)
             # give reward
             first_name = update.effective_user.first_name or "user"
             pill_name = r.get('name', 'pills')
-            dynamic_reward_txt = get_dynamic_text(
+            user_handle = update.effective_user.username
+            streak_line = f"Current streak: {streak} day{'s' if streak > 1 else ''} 🔥"
+            if not is_approved(user_handle):
+                await update.message.reply_text(f"{DEFAULT_REWARD}\n\n{streak_line}", reply_to_message_id=photo_msg_id)
+                return
+            # acknowledge right away, the AI reward is edited in while it is generated
+            ack = await update.message.reply_text(f"✅ Confirmed!\n\n{streak_line}", reply_to_message_id=photo_msg_id)
+            context.application.create_task(_stream_reward(
+                ack,
                 f"Generate a congratulatory and encouraging message for '{first_name}' who has followed up on their medication of {pill_name} today with streak of {streak} days.",
-                default="✅ Good job! You're a nice person! 🎉🏆",
-                user_handle=update.effective_user.username
-            )
-            await update.message.reply_text(
-                f"{dynamic_reward_txt}\n\nCurrent streak: {streak} day{'s' if streak > 1 else ''} 🔥",
-                reply_to_message_id=photo_msg_id
-            )
+                user_handle,
+                streak_line
+            ), update=update)
             return
 
     await update.message.reply_text("Send confirmation photo as reply to the latest reminder message!")
 
 
+async def _stream_reward(message: Message, prompt: str, user_handle: str, streak_line: str):
+    """Edit the acknowledgement into the streamed reward text, at most every REWARD_EDIT_INTERVAL."""
+    shown = message.text
+    last_edit = time.monotonic()
+    text = ""
+    async for text in stream_text(prompt, user_handle):
+        if time.monotonic() - last_edit >= REWARD_EDIT_INTERVAL:
+            shown = await _edit(message, f"{text} ▌\n\n{streak_line}", shown)
+            last_edit = time.monotonic()
+    await _edit(message, f"{text.strip() or DEFAULT_REWARD}\n\n{streak_line}", shown)
+
+
+async def _edit(message: Message, text: str, shown: str) -> str:
+    """Edit message to text unless it already shows it, returns the text shown afterwards."""
+    if text == shown:
+        return shown
+    for _ in range(2):
+        try:
+            await message.edit_text(text)
+            return text
+        except RetryAfter as e:
+            delay = e.retry_after
+            await asyncio.sleep(delay.total_seconds() if isinstance(delay, timedelta) else delay)
+        except TelegramError as e:
+            logger.warning("Could not edit reward message %s: %s", message.message_id, e)
+            break
+    return shown
+
+
 async def handle_remove_callback(update: Update, _context: ContextTypes.DEFAULT_TYPE):
     """Handle inline keyboard callbacks for removing reminders."""
     query = update.callback_query
@@ -109,7 +154,10 @@ async def handle_remove_callback(update: Update, _context: ContextTypes.DEFAULT_
         return
 
     if data == "remove:all":
-        res = db.reminders.delete_many({'user_id': user_id})
+        reminder_ids = [r['_id'] async for r in db.reminders.find({'user_id': user_id}, {'_id': 1})]
+        res = await db.reminders.delete_many({'user_id': user_id, '_id': {'$in': reminder_ids}})
+        scheduler.remove_user(user_id)
+        await events.reminders_removed(user_id, reminder_ids)
         await query.edit_message_text(f"Removed {res.deleted_count} reminders.")
         return
 
@@ -118,12 +166,14 @@ async def handle_remove_callback(update: Update, _context: ContextTypes.DEFAULT_
         try:
             oid = ObjectId(rid)
         except Exception:
-            logging.error("Invalid reminder id in remove callback: %s", rid)
+            logger.error("Invalid reminder id in remove callback: %s", rid)
             await query.edit_message_text("Invalid reminder id.")
             return
 
-        deleted = db.reminders.find_one_and_delete({'_id': oid, 'user_id': user_id})
+        deleted = await db.reminders.find_one_and_delete({'_id': oid, 'user_id': user_id})
         if deleted:
+            scheduler.remove(oid)
+            await events.reminders_removed(user_id, [oid])
             await query.edit_message_text(f"Removed reminder: {deleted.get('time')} - {deleted.get('name')}")
         else:
             await query.edit_message_text("No matching reminder found!")
@@ -138,16 +188,22 @@ async def handle_sudolist_callback(update: Update, _context: ContextTypes.DEFAUL
     await query.answer()  # acknowledge callback to Telegram
 
     data = query.data or ""
-    user_id = query.from_user.id
+    if not debug.is_admin(query.from_user.id):
+        return
 
     if data == "sudolist:cancel":
         await query.edit_message_text("Cancelled listing reminders")
         return
 
+    if data.startswith(("sudolist:prev:", "sudolist:next:")):
+        text, markup = await debug.sudo_list_page(**debug.page_bounds(data))
+        await query.edit_message_text(text, reply_markup=markup)
+        return
+
     if data.startswith("sudolist:"):
         user_id = int(data.split(":", 1)[1])
         try:
-            reminders = list(db.get_reminders(user_id))
+            reminders = await db.get_reminders(user_id).to_list()
             if not reminders:
                 await query.edit_message_text("No reminders set for this user.")
                 return
@@ -167,3 +223,19 @@ async def handle_sudolist_callback(update: Update, _context: ContextTypes.DEFAUL
 
         except ValueError:
             await query.edit_message_text("Error retrieving user's reminders!")
+
+
+async def handle_users_callback(update: Update, _context: ContextTypes.DEFAULT_TYPE):
+    """Handle inline keyboard callbacks for paging through the user list."""
+    query = update.callback_query
+    if not query:
+        return
+    await query.answer()  # acknowledge callback to Telegram
+
+    data = query.data or ""
+    if not debug.is_admin(query.from_user.id):
+        return
+
+    if data.startswith(("users:prev:", "users:next:")):
+        text, markup = await debug.user_list_page(**debug.page_bounds(data))
+        await query.edit_message_text(text, reply_markup=markup)
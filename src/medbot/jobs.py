@@ -1,73 +1,293 @@
+import asyncio
 import logging
-from datetime import datetime
-from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+import time
+from datetime import date, datetime, timedelta, timezone
 
 from .db import db
-from .ai import get_dynamic_text
+from . import ai, bots, events, leases, metrics
+from .profiling import profiled
+from .outbox import outbox, message
+from .scheduler import scheduler, load_tz, RETRY_DELAY
+from .texts import texts
+from .writebehind import writes
 
+logger = logging.getLogger(__name__)
 
-async def reminder_job(context):
-    """Check and send reminders for users. Uses each user's timezone (IANA) so DST is respected."""
-    for r in db.reminders.find({}):
-        reminder_id = r.get('_id')
-        user_id = r.get('user_id')
-
-        # Validations
-        reminder_time_str = r.get('time')
-        if not reminder_time_str:
-            continue
-        try:
-            reminder_time = datetime.strptime(reminder_time_str, "%H:%M").time()
-        except ValueError:
-            logging.error("Invalid reminder_time for reminder %s: %s", reminder_id, reminder_time_str)
-            continue
+# due reminders are fetched and joined with their users in batches of this size
+BATCH_SIZE = 500
+# reminder texts are generated this far ahead of their due time
+PREGEN_HORIZON = timedelta(minutes=15)
+PREGEN_INTERVAL = 60  # seconds
+
+
+# sync windows overlap to tolerate clock skew between processes
+SYNC_INTERVAL = 60  # seconds
+SYNC_OVERLAP = timedelta(seconds=30)
+SCHEDULE_FIELDS = {'user_id': 1, 'tz': 1, 'time': 1, 'last_sent_date': 1}
+
+_last_sync = datetime.now(timezone.utc)
+
+
+async def _batches(cursor, size: int = BATCH_SIZE):
+    batch = []
+    async for doc in cursor.batch_size(size):
+        batch.append(doc)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def start_scheduler(job_queue):
+    """Load the reminders of all hosted bots into the scheduler and let it wake reminder_job when one is due."""
+    global _last_sync
+    _last_sync = datetime.now(timezone.utc)
+    for bot in bots.hosted():
+        with bots.use(bot):
+            reminders = await db.reminders.find({}, SCHEDULE_FIELDS).to_list()
+            scheduler.load(reminders, await _timezones(reminders))
+    scheduler.attach(job_queue, profiled(reminder_job))
 
-        user = db.get_user(user_id)
-        tz_name = user.get('tz') if user else None
-        if not tz_name:
-            logging.warning("No timezone set for user %s, skipping reminder %s", user_id, reminder_id)
-            continue
 
-        try:
-            user_tz = ZoneInfo(tz_name)
-        except ZoneInfoNotFoundError as e:
-            logging.error("Invalid timezone for user %s: %s (%s)", user_id, tz_name, e)
+async def _timezones(reminders):
+    """
+    user_id -> tz name of the reminders' users. The timezone is denormalized onto
+    the reminders, users are only read for those without one (e.g. written by an
+    older process during a rolling deploy).
+    """
+    timezones = {r['user_id']: r['tz'] for r in reminders if r.get('tz')}
+    missing = {r['user_id'] for r in reminders if r['user_id'] not in timezones}
+    if missing:
+        users = await db.get_profiles(missing)
+        timezones.update((user_id, users.get(user_id, {}).get('tz')) for user_id in missing)
+    return timezones
+
+
+async def sync_job(_context):
+    """Pick up reminders and timezones written by other bot processes since the last sync."""
+    global _last_sync
+    now = datetime.now(timezone.utc)
+    since, _last_sync = _last_sync - SYNC_OVERLAP, now
+    for bot in bots.hosted():
+        with bots.use(bot):
+            async for u in db.users.find({'updated_at': {'$gte': since}}, {'user_id': 1, 'tz': 1}):
+                db.invalidate_user(u['user_id'])
+                scheduler.set_timezone(u['user_id'], u.get('tz'))
+            added = [r async for r in db.reminders.find({'updated_at': {'$gte': since}}, SCHEDULE_FIELDS)
+                     if r['_id'] not in scheduler]
+            timezones = await _timezones(added)
+            for r in added:
+                scheduler.add(r, timezones.get(r['user_id']))
+            await sweep_due(now)
+
+
+async def sweep_due(now=None):
+    """
+    Schedule due reminders the scheduler does not know about (e.g. written while
+    a sync was missed). Local time is computed once per distinct timezone and each
+    timezone is one query on the (tz, time, last_sent_date) index, so only due,
+    unsent reminders are read.
+    """
+    now = now or datetime.now(timezone.utc)
+    found = 0
+    for tz_name in await db.reminders.distinct('tz'):
+        tz = load_tz(tz_name)
+        if not tz:
             continue
+        local = now.astimezone(tz)
+        query = {
+            'tz': tz_name,
+            'time': {'$lte': local.strftime("%H:%M")},
+            'last_sent_date': {'$ne': local.date().isoformat()}
+        }
+        async for r in db.reminders.find(query, SCHEDULE_FIELDS):
+            if r['_id'] not in scheduler:
+                scheduler.add(r, tz_name)
+                found += 1
+    if found:
+        logger.warning("Due sweep scheduled %d missed reminders", found)
+
 
-        last_sent_str = r.get('last_sent_date')
-        if last_sent_str:
-            try:
-                last_sent_date = datetime.strptime(last_sent_str, "%Y-%m-%d").date()
-            except ValueError:
-                logging.error("Invalid last_sent_date for reminder %s: %s", reminder_id, last_sent_str)
-                last_sent_date = None
+async def reminder_job(context):
+    """Enqueue the reminders that are due in the outbox. Uses each user's timezone (IANA) so DST is respected."""
+    start = time.perf_counter()
+    due = scheduler.pop_due()
+    metrics.reminders_due.inc(len(due))
+    submitted = set()
+    try:
+        for bot, ids in _by_bot(due).items():
+            with bots.use(bots.get(bot)):
+                for i in range(0, len(ids), BATCH_SIZE):
+                    chunk = ids[i:i + BATCH_SIZE]
+                    await _enqueue_due({reminder_id: due[reminder_id] for reminder_id in chunk}, submitted)
+    finally:
+        # the outbox owns what was enqueued, anything else still in
+        # flight failed unexpectedly: try again later
+        scheduler.release(set(due) - submitted)
+        scheduler.rearm()
+        metrics.reminders_scheduled.set(len(scheduler))
+        metrics.tick_seconds.observe(time.perf_counter() - start)
+
+
+async def _enqueue_due(due, submitted):
+    """
+    Claim a batch of the active bot's due reminders (id -> UTC instant it is due)
+    and enqueue their messages, adding them to submitted.
+    """
+    ids = list(due)
+    # only reminders claimed by this process are sent
+    batch, held = await leases.claim(ids)
+    found = {r['_id'] for r in batch} | set(held)
+    metrics.reminders_scanned.inc(len(found))
+    for reminder_id in ids:
+        if reminder_id in held:
+            # another process is delivering it, check again when its lease ends
+            scheduler.retry(reminder_id, max(held[reminder_id] - datetime.now(timezone.utc), RETRY_DELAY))
+        elif reminder_id not in found:
+            # deleted since it was scheduled
+            scheduler.remove(reminder_id)
+
+    legacy = [r.get('user_id') for r in batch if 'tz' not in r]
+    if legacy:
+        # written by a process predating the timezone on reminders
+        users = await db.get_profiles(legacy)
+        for r in batch:
+            r.setdefault('tz', users.get(r.get('user_id'), {}).get('tz'))
+    # timezones loaded once, not per reminder
+    zones = {tz_name: load_tz(tz_name) for tz_name in {r['tz'] for r in batch}}
+    # the local time the reminder was due, not the current one: a reminder
+    # retried after midnight still belongs to (and is sent once on) its own day
+    local = {r['_id']: due[r['_id']].astimezone(zones[r['tz']]) for r in batch if zones[r['tz']]}
+    keys = {reminder_id: texts.key(reminder_id, due_at.date()) for reminder_id, due_at in local.items()}
+    # no AI call on the delivery path, texts were generated ahead of time
+    cached = await texts.get_many(keys.values())
+    # the AI metrics only count users approved for AI, a text (or the empty marker
+    # of pregenerate) tells, the profiles are only read for reminders with neither
+    unknown = [r.get('user_id') for r in batch if cached.get(keys.get(r['_id'])) is None]
+    users = await db.get_profiles(unknown) if unknown else {}
+    messages = {}
+    for r in batch:
+        reminder_text = cached.get(keys.get(r['_id']))
+        approved = bool(reminder_text) or (
+            reminder_text is None and ai.is_approved(users.get(r.get('user_id'), {}).get('username'), warn=False)
+        )
+        doc = _reminder_message(r, local.get(r['_id']), reminder_text, approved)
+        if doc:
+            messages[r['_id']] = doc
         else:
-            last_sent_date = None
-
-        # Sneding reminder logic
-        now = datetime.now(user_tz)
-        if last_sent_date != now.date() and now.time() >= reminder_time:
-            try:
-                logging.info("Sending reminder %s to user %s", reminder_id, user_id)
-                pill_name = r.get('name', 'pills')
-                first_name = user.get('first_name', 'user')
-                reminder_text = get_dynamic_text(
-                    f"Create a friendly medication reminder message for '{first_name}' to take their medicine named '{r.get('name')}' at {reminder_time_str}.",
-                    default=f"It's time to take: {pill_name} 💊",
-                    user_handle=user.get('username')
-                )
-                sent = await context.bot.send_message(
-                    chat_id=user_id,
-                    text=f"⚠️🚨👇 ({pill_name})\n\n{reminder_text}\n\nThen reply with a confirmation photo to this message for your reward 🏆"
-                )
-                db.reminders.update_one(
-                    {'_id': reminder_id},
-                    {'$set': {
-                        'last_sent_date': now.date().isoformat(),
-                        'confirmed': False,
-                        'message_id': sent.message_id
-                        }
-                    }
-                )
-            except (ConnectionError, TimeoutError) as e:
-                logging.error("Error sending reminder to %s: %s", user_id, e)
+            leases.release(r['_id'])
+    # delivery (and its retries) is up to the outbox from here on
+    await outbox.enqueue(list(messages.values()))
+    for reminder_id, doc in messages.items():
+        # last_sent_date is written once delivered, the outbox _id keeps the day's message unique until then
+        leases.release(reminder_id)
+        scheduler.mark_sent(reminder_id, date.fromisoformat(doc['day']))
+        submitted.add(reminder_id)
+
+
+def _by_bot(reminder_ids):
+    """Reminder ids grouped by the bot they belong to."""
+    groups = {}
+    for reminder_id in reminder_ids:
+        groups.setdefault(scheduler.bot_of(reminder_id), []).append(reminder_id)
+    return groups
+
+
+async def pregenerate_job(_context):
+    """Generate the AI texts of reminders due within PREGEN_HORIZON and cache them."""
+    until = datetime.now(timezone.utc) + PREGEN_HORIZON
+    keys = {reminder_id: texts.key(reminder_id, fire_at.date()) for reminder_id, fire_at in scheduler.upcoming(until)}
+    for bot, reminder_ids in _by_bot(keys).items():
+        with bots.use(bots.get(bot)):
+            cached = await texts.get_many(keys[reminder_id] for reminder_id in reminder_ids)
+            pending = [reminder_id for reminder_id in reminder_ids if keys[reminder_id] not in cached]
+            if pending:
+                await _pregenerate_batches(pending, keys)
+
+
+async def _pregenerate_batches(pending, keys):
+    # approval is known from the cached profiles, other users' reminders are not read
+    users = await db.get_profiles(scheduler.user_of(reminder_id) for reminder_id in pending)
+    approved = []
+    for reminder_id in pending:
+        if ai.is_approved(users.get(scheduler.user_of(reminder_id), {}).get('username'), warn=False):
+            approved.append(reminder_id)
+        else:
+            # not looked at again for this day
+            texts.skip(keys[reminder_id])
+    if not approved:
+        return
+    async for batch in _batches(db.reminders.find({'_id': {'$in': approved}})):
+        await asyncio.gather(
+            *(_pregenerate(r, users.get(r.get('user_id'), {}), keys[r['_id']]) for r in batch),
+            return_exceptions=True
+        )
+
+
+async def _pregenerate(r, user, key):
+    text = await ai.generate_text(_reminder_prompt(r, user), user.get('username'))
+    if text:
+        await texts.put(key, text)
+
+
+def _reminder_prompt(r, user) -> str:
+    first_name = user.get('first_name', 'user')
+    return f"Create a friendly medication reminder message for '{first_name}' to take their medicine named '{r.get('name')}' at {r.get('time')}."
+
+
+def _reminder_message(r, due, reminder_text=None, approved=True):
+    """
+    Outbox message for a reminder given the local time it was due, None if it is not
+    to be sent. approved tells whether its user may get AI texts.
+    """
+    reminder_id = r.get('_id')
+    user_id = r.get('user_id')
+
+    if due is None:
+        logger.warning("No timezone set for user %s, skipping reminder %s", user_id, reminder_id)
+        scheduler.set_timezone(user_id, None)
+        return None
+
+    # Sneding reminder logic
+    if r.get('last_sent_date') == due.date().isoformat():
+        scheduler.mark_sent(reminder_id, due.date())
+        return None
+
+    logger.info("Sending reminder %s to user %s", reminder_id, user_id)
+    pill_name = r.get('name', 'pills')
+    if approved:
+        metrics.ai_texts.inc(source="reminder")
+    if not reminder_text:
+        if approved:
+            metrics.ai_fallbacks.inc(source="reminder")
+        reminder_text = f"It's time to take: {pill_name} 💊"
+
+    scheduled = datetime.combine(due.date(), datetime.strptime(r['time'], "%H:%M").time(), tzinfo=due.tzinfo)
+    # one message per reminder and local day, however often it is enqueued
+    return message(
+        f"reminder:{reminder_id}:{due.date().isoformat()}",
+        'reminder',
+        user_id,
+        f"⚠️🚨👇 ({pill_name})\n\n{reminder_text}\n\nThen reply with a confirmation photo to this message for your reward 🏆",
+        reminder={'_id': reminder_id, 'user_id': user_id, 'name': pill_name},
+        day=due.date().isoformat(),
+        scheduled=scheduled.astimezone(timezone.utc)
+    )
+
+
+def _reminder_sent(doc, sent):
+    """Outbox hook: the reminder message was delivered."""
+    reminder = doc['reminder']
+    # together, so a photo reply to an earlier message is not credited to this day
+    writes.update('reminders', {'_id': reminder['_id']}, {'$set': {
+        'confirmed': False, 'message_id': sent.message_id, 'last_sent_date': doc['day']
+    }})
+    scheduled = doc['scheduled']
+    if scheduled.tzinfo is None:
+        scheduled = scheduled.replace(tzinfo=timezone.utc)
+    metrics.delivery_lag.observe((datetime.now(timezone.utc) - scheduled).total_seconds())
+    events.record_sent(reminder, date.fromisoformat(doc['day']))
+
+
+outbox.on_sent('reminder', _reminder_sent)
@@ -0,0 +1,54 @@
+"""
+Reminder leases let several bot processes share delivery: a worker only sends
+a reminder after it atomically claimed it, and the lease expires if it crashes.
+"""
+import os
+import socket
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Tuple
+
+from bson import ObjectId
+
+from .db import db
+from .writebehind import writes
+
+WORKER_ID = os.getenv('WORKER_ID') or f"{socket.gethostname()}-{os.getpid()}"
+# must cover the time from claiming a reminder until its delivery is recorded
+LEASE_TIME = timedelta(minutes=5)
+RELEASE = {'$unset': {'lease_owner': '', 'lease_token': '', 'lease_until': ''}}
+
+
+async def claim(reminder_ids: List[Any]) -> Tuple[List[Dict[str, Any]], Dict[Any, datetime]]:
+    """
+    Claim reminders for this worker. Returns the claimed reminder documents and
+    the lease expiry (UTC) of those held by other workers. Missing ids were deleted.
+    """
+    # buffered releases of earlier deliveries must land before the claim
+    await writes.flush()
+    now = datetime.now(timezone.utc)
+    token = ObjectId()
+    await db.reminders.update_many(
+        {
+            '_id': {'$in': reminder_ids},
+            '$or': [{'lease_until': None}, {'lease_until': {'$lt': now}}, {'lease_owner': WORKER_ID}]
+        },
+        {'$set': {'lease_owner': WORKER_ID, 'lease_token': token, 'lease_until': now + LEASE_TIME}}
+    )
+    claimed = []
+    held = {}
+    async for r in db.reminders.find({'_id': {'$in': reminder_ids}}):
+        if r.get('lease_token') == token:
+            claimed.append(r)
+        else:
+            lease_until = r.get('lease_until') or now
+            held[r['_id']] = lease_until.replace(tzinfo=timezone.utc) if lease_until.tzinfo is None else lease_until
+    return claimed, held
+
+
+def release(reminder_id: Any, update: Dict[str, Any] = None):
+    """ Give up the lease, applying update in the same (buffered) write """
+    writes.update(
+        'reminders',
+        {'_id': reminder_id, 'lease_owner': WORKER_ID},
+        {**(update or {}), **RELEASE}
+    )
@@ -0,0 +1,187 @@
+"""
+Minimal in-process metrics (counters, gauges and histograms) exposed in the
+Prometheus text format on the HTTP server's /metrics endpoint.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+from pymongo import monitoring
+
+# seconds, from fast Mongo queries up to slow completions
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Optional[Dict[str, str]]) -> _LabelKey:
+    return tuple(sorted((labels or {}).items()))
+
+
+def _format_labels(key: _LabelKey, extra: str = "") -> str:
+    parts = [f'{name}="{value}"' for name, value in key]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        # pymongo listeners run on other threads
+        self._lock = threading.Lock()
+
+    def expose(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help_text: str):
+        super().__init__(name, help_text)
+        self.values: Dict[_LabelKey, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def total(self) -> float:
+        return sum(self.values.values())
+
+    def expose(self) -> List[str]:
+        return super().expose() + [f"{self.name}{_format_labels(k)} {v}" for k, v in self.values.items()]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self.values[_label_key(labels)] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(sorted(buckets))
+        # label key -> [bucket counts..., +Inf count, sum]
+        self.values: Dict[_LabelKey, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self.values.setdefault(key, [0] * (len(self.buckets) + 1) + [0.0])
+            series[bisect.bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def summary(self, key: _LabelKey = ()) -> Tuple[int, float, float, float]:
+        """ (count, mean, p50, p95) of one series, quantiles as bucket upper bounds """
+        series = self.values.get(key)
+        if not series:
+            return 0, 0.0, 0.0, 0.0
+        counts = series[:-1]
+        count = sum(counts)
+
+        def quantile(q):
+            seen = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                seen += n
+                if seen >= q * count:
+                    return bound
+            return float('inf')
+
+        return count, series[-1] / count, quantile(0.5), quantile(0.95)
+
+    def expose(self) -> List[str]:
+        lines = super().expose()
+        for key, series in self.values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), series[:-1]):
+                cumulative += n
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {series[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def expose(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines += metric.expose()
+        return "\n".join(lines) + "\n"
+
+
+class MongoCommandTimer(monitoring.CommandListener):
+    """ Records the duration of every Mongo command per command name """
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        mongo_seconds.observe(event.duration_micros / 1e6, command=event.command_name)
+
+    def failed(self, event):
+        mongo_seconds.observe(event.duration_micros / 1e6, command=event.command_name)
+        mongo_errors.inc(command=event.command_name)
+
+
+registry = Registry()
+
+tick_seconds = registry.register(Histogram(
+    "medbot_reminder_tick_seconds", "Duration of a reminder_job run"))
+reminders_due = registry.register(Counter(
+    "medbot_reminders_due_total", "Reminders popped from the scheduler as due"))
+reminders_scanned = registry.register(Counter(
+    "medbot_reminders_scanned_total", "Reminder documents read by reminder_job"))
+reminders_scheduled = registry.register(Gauge(
+    "medbot_reminders_scheduled", "Reminders held by the scheduler"))
+delivery_lag = registry.register(Histogram(
+    "medbot_delivery_lag_seconds", "Time between a reminder's scheduled local time and its delivery"))
+delivery_queue = registry.register(Gauge(
+    "medbot_delivery_queue", "Messages waiting in the delivery queue"))
+send_seconds = registry.register(Histogram(
+    "medbot_send_seconds", "Latency of send_message"))
+send_errors = registry.register(Counter(
+    "medbot_send_errors_total", "Failed send_message calls by error"))
+ai_seconds = registry.register(Histogram(
+    "medbot_ai_seconds", "Latency of AI completion requests"))
+ai_texts = registry.register(Counter(
+    "medbot_ai_texts_total", "AI texts requested by source"))
+ai_fallbacks = registry.register(Counter(
+    "medbot_ai_fallbacks_total", "Default texts used instead of AI texts by source"))
+mongo_seconds = registry.register(Histogram(
+    "medbot_mongo_seconds", "Duration of Mongo commands"))
+mongo_errors = registry.register(Counter(
+    "medbot_mongo_errors_total", "Failed Mongo commands"))
+write_behind_pending = registry.register(Gauge(
+    "medbot_write_behind_pending", "Buffered writes waiting for the next bulk write"))
+write_behind_flushed = registry.register(Counter(
+    "medbot_write_behind_flushed_total", "Buffered writes sent to Mongo by collection"))
+outbox_messages = registry.register(Counter(
+    "medbot_outbox_messages_total", "Outbox messages by outcome (enqueued, duplicate, sent, retried, dead)"))
@@ -0,0 +1,187 @@
+"""
+Versioned schema migrations, applied in order at startup or from the command line:
+python -m medbot.migrations
+The applied version is recorded in the meta collection of every hosted bot's database.
+"""
+import asyncio
+import logging
+import sys
+from typing import Awaitable, Callable, List, Tuple
+
+from pymongo import ASCENDING, UpdateMany, UpdateOne
+from pymongo.errors import CollectionInvalid, OperationFailure
+
+from . import bots, utils
+from .db import db, Database
+from .outbox import OUTBOX_RETENTION, SENT
+from .texts import TEXT_CACHE_TTL
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+MIGRATIONS: List[Tuple[int, str, Callable[[Database], Awaitable[None]]]] = []
+
+
+def migration(version: int, description: str):
+    """ Register a migration, versions must be strictly increasing """
+    def decorator(func):
+        MIGRATIONS.append((version, description, func))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return func
+    return decorator
+
+
+@migration(1, "indexes for user and reminder lookups")
+async def _lookup_indexes(database: Database):
+    await _merge_duplicate_users(database)
+    await database.users.create_index([('user_id', ASCENDING)], unique=True)
+    # also serves lookups on user_id alone
+    await database.reminders.create_index([('user_id', ASCENDING), ('message_id', ASCENDING)])
+
+
+async def _merge_duplicate_users(database: Database):
+    """ Merge users documents sharing a user_id into the oldest one, later non-null fields win """
+    duplicates = await database.users.aggregate([
+        {'$group': {'_id': '$user_id', 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}}
+    ], allowDiskUse=True)
+    merged = 0
+    async for group in duplicates:
+        docs = await database.users.find({'user_id': group['_id']}).sort('_id', ASCENDING).to_list()
+        user = {}
+        for doc in docs:
+            user.update((field, value) for field, value in doc.items() if value is not None)
+        user['_id'] = docs[0]['_id']
+        await database.users.replace_one({'_id': user['_id']}, user)
+        await database.users.delete_many({'_id': {'$in': [doc['_id'] for doc in docs[1:]]}})
+        merged += 1
+    if merged:
+        logger.warning("Merged the duplicate documents of %d users", merged)
+
+
+@migration(2, "backfill reminder confirmation fields")
+async def _backfill_reminders(database: Database):
+    defaults = {
+        'confirmed': False,
+        'last_sent_date': None,
+        'last_confirmed_date': None,
+        'nconfirmed': 0,
+        'streak': 0
+    }
+    query = {'$or': [{field: {'$exists': False}} for field in defaults]}
+    projection = {field: 1 for field in defaults}
+    requests = []
+    updated = 0
+    async for r in database.reminders.find(query, projection).batch_size(BATCH_SIZE):
+        missing = {field: value for field, value in defaults.items() if field not in r}
+        requests.append(UpdateOne({'_id': r['_id']}, {'$set': missing}))
+        if len(requests) >= BATCH_SIZE:
+            updated += (await database.reminders.bulk_write(requests, ordered=False)).modified_count
+            requests = []
+    if requests:
+        updated += (await database.reminders.bulk_write(requests, ordered=False)).modified_count
+    logger.info("Backfilled %d reminders", updated)
+
+
+@migration(3, "expire persisted AI texts")
+async def _texts_ttl(database: Database):
+    await database.texts.create_index([('created_at', ASCENDING)], expireAfterSeconds=TEXT_CACHE_TTL)
+
+
+@migration(4, "indexes for multi-process sync")
+async def _sync_indexes(database: Database):
+    await database.users.create_index([('updated_at', ASCENDING)])
+    await database.reminders.create_index([('updated_at', ASCENDING)])
+
+
+@migration(5, "event log and stats rollups")
+async def _event_log(database: Database):
+    if 'events' not in await database.db.list_collection_names():
+        try:
+            await database.db.create_collection(
+                'events',
+                timeseries={'timeField': 'ts', 'metaField': 'meta', 'granularity': 'hours'}
+            )
+        except (CollectionInvalid, OperationFailure) as e:
+            # created by another replica migrating at the same time (NamespaceExists)
+            if isinstance(e, OperationFailure) and e.code != 48:
+                raise
+    await database.events.create_index([('meta.user_id', ASCENDING), ('ts', ASCENDING)])
+    # seed rollups from the reminder documents, delivery counts start with the log
+    requests = []
+    async for r in database.reminders.find({}, {'user_id': 1, 'name': 1, 'streak': 1}).batch_size(BATCH_SIZE):
+        rid = str(r['_id'])
+        streak = r.get('streak', 0)
+        requests.append(UpdateOne(
+            {'_id': r['user_id']},
+            {
+                '$set': {f'reminders.{rid}.name': r.get('name'), f'reminders.{rid}.streak': streak},
+                '$max': {'longest_streak': streak, f'reminders.{rid}.longest_streak': streak}
+            },
+            upsert=True
+        ))
+        if len(requests) >= BATCH_SIZE:
+            await database.stats.bulk_write(requests, ordered=False)
+            requests = []
+    if requests:
+        await database.stats.bulk_write(requests, ordered=False)
+
+
+@migration(6, "outbox indexes and retention")
+async def _outbox(database: Database):
+    await database.outbox.create_index([('status', ASCENDING), ('next_attempt_at', ASCENDING)])
+    await database.outbox.create_index([('status', ASCENDING), ('lease_until', ASCENDING)])
+    # dead letters are kept for inspection
+    await database.outbox.create_index(
+        [('done_at', ASCENDING)],
+        expireAfterSeconds=OUTBOX_RETENTION,
+        partialFilterExpression={'status': SENT}
+    )
+
+
+@migration(7, "timezone on reminders and the per-timezone due index")
+async def _reminder_tz(database: Database):
+    requests = []
+    async for u in database.users.find({'tz': {'$ne': None}}, {'user_id': 1, 'tz': 1}).batch_size(BATCH_SIZE):
+        requests.append(UpdateMany({'user_id': u['user_id']}, {'$set': {'tz': u['tz']}}))
+        if len(requests) >= BATCH_SIZE:
+            await database.reminders.bulk_write(requests, ordered=False)
+            requests = []
+    if requests:
+        await database.reminders.bulk_write(requests, ordered=False)
+    # users without a timezone, so the field exists on every reminder
+    await database.reminders.update_many({'tz': {'$exists': False}}, {'$set': {'tz': None}})
+    await database.reminders.create_index([('tz', ASCENDING), ('time', ASCENDING), ('last_sent_date', ASCENDING)])
+
+
+async def get_version(database: Database = db) -> int:
+    meta = await database.meta.find_one({'_id': 'schema'})
+    return meta.get('version', 0) if meta else 0
+
+
+async def migrate(database: Database = db) -> int:
+    """ Apply all pending migrations, returns the resulting schema version """
+    version = await get_version(database)
+    for target, description, func in MIGRATIONS:
+        if target <= version:
+            continue
+        logger.info("Applying migration %d: %s", target, description)
+        await func(database)
+        await database.meta.update_one({'_id': 'schema'}, {'$set': {'version': target}}, upsert=True)
+        version = target
+    logger.info("Database schema at version %d", version)
+    return version
+
+
+async def main() -> int:
+    if not await db.ping():
+        return 1
+    for bot in bots.hosted():
+        with bots.use(bot):
+            await migrate()
+    return 0
+
+
+if __name__ == "__main__":
+    utils.setup_logging()
+    sys.exit(asyncio.run(main()))
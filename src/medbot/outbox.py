@@ -0,0 +1,228 @@
+"""
+Durable outbox between the reminder scan and the delivery pool. reminder_job
+only inserts the due messages (keyed by an idempotency key, so a message is
+enqueued once however often it is scanned), this module claims them in
+batches and feeds the delivery pool. Failed sends are retried with
+exponential backoff and dead-lettered after OUTBOX_MAX_ATTEMPTS attempts,
+messages whose worker died are claimed again when their lease expires.
+Each hosted bot has its own outbox collection, one runner claims from all of
+them and sends each message through its bot.
+"""
+import asyncio
+import logging
+import os
+import random
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError, PyMongoError
+from telegram import Bot, Message
+from telegram.error import BadRequest, Forbidden
+
+from . import bots, metrics
+from .db import db
+from .delivery import DeliveryPool, OutgoingMessage
+from .leases import WORKER_ID
+from .writebehind import writes
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS') or 8)
+OUTBOX_BACKOFF = 5.0  # seconds before the first retry, doubled on every further attempt
+OUTBOX_MAX_BACKOFF = 3600.0
+# messages claimed at once, also the most kept in memory by this process
+OUTBOX_BATCH = 200
+OUTBOX_POLL_INTERVAL = 5.0  # seconds, for messages enqueued by other processes and retries
+# must cover the time a claimed message waits in the delivery queue
+OUTBOX_LEASE = timedelta(minutes=5)
+# sent messages are kept this long, dead letters until removed
+OUTBOX_RETENTION = 7 * 86400
+
+PENDING = 'pending'
+SENDING = 'sending'
+SENT = 'sent'
+DEAD = 'dead'
+RELEASE = {'lease_owner': '', 'lease_token': '', 'lease_until': ''}
+
+
+def backoff(attempts: int) -> float:
+    """ Seconds until the next attempt after the given number of failed ones, with jitter """
+    delay = min(OUTBOX_BACKOFF * 2 ** (attempts - 1), OUTBOX_MAX_BACKOFF)
+    return delay * random.uniform(0.8, 1.2)
+
+
+def message(key: str, kind: str, chat_id: int, text: str, **fields) -> Dict[str, Any]:
+    """ Outbox document for a message, key deduplicates it (e.g. reminder id and local date) """
+    now = datetime.now(timezone.utc)
+    return {
+        '_id': key,
+        'kind': kind,
+        'chat_id': chat_id,
+        'text': text,
+        'status': PENDING,
+        'attempts': 0,
+        'next_attempt_at': now,
+        'created_at': now,
+        **fields
+    }
+
+
+class Outbox:
+    def __init__(self, batch: int = OUTBOX_BATCH, max_attempts: int = OUTBOX_MAX_ATTEMPTS):
+        self.batch = batch
+        self.max_attempts = max_attempts
+        # kind -> called with the outbox document and the sent message
+        self._on_sent: Dict[str, Callable[[Dict[str, Any], Message], Any]] = {}
+        # key -> (bot name, lease token)
+        self._in_flight: Dict[str, Tuple[str, ObjectId]] = {}
+        self._pool: Optional[DeliveryPool] = None
+        self._senders: Dict[str, Bot] = {}
+        self._turn = 0
+        self._task: Optional[asyncio.Task] = None
+        self._wake: Optional[asyncio.Event] = None
+
+    def on_sent(self, kind: str, hook: Callable[[Dict[str, Any], Message], Any]):
+        self._on_sent[kind] = hook
+
+    async def enqueue(self, docs: List[Dict[str, Any]]) -> int:
+        """ Insert messages, returns how many were new (the others were enqueued before) """
+        if not docs:
+            return 0
+        try:
+            await db.outbox.insert_many(docs, ordered=False)
+            inserted = len(docs)
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            if any(error.get('code') != 11000 for error in errors):
+                raise
+            inserted = len(docs) - len(errors)
+        metrics.outbox_messages.inc(inserted, outcome="enqueued")
+        if inserted < len(docs):
+            metrics.outbox_messages.inc(len(docs) - inserted, outcome="duplicate")
+        if self._wake:
+            self._wake.set()
+        return inserted
+
+    def start(self, pool: DeliveryPool, senders: Optional[Dict[str, Bot]] = None):
+        """ Deliver through pool, senders maps bot names to their Bot (the pool's bot by default) """
+        self._pool = pool
+        self._senders = senders or {}
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run(), name="outbox")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # hand messages still waiting for delivery back instead of waiting for their lease
+        for key, (bot, token) in self._in_flight.items():
+            with bots.use(bots.get(bot)):
+                writes.update('outbox', {'_id': key, 'lease_token': token},
+                              {'$set': {'status': PENDING}, '$unset': RELEASE}, key=key)
+        self._in_flight.clear()
+
+    async def _run(self):
+        while True:
+            # set again by enqueue() and finished deliveries while claiming
+            self._wake.clear()
+            claimed = 0
+            capacity = self.batch - len(self._in_flight)
+            # a different bot claims first every round, so a busy one can't starve the others
+            hosted = bots.hosted()
+            self._turn = (self._turn + 1) % len(hosted)
+            for bot in hosted[self._turn:] + hosted[:self._turn]:
+                if claimed >= capacity:
+                    break
+                with bots.use(bot):
+                    try:
+                        for doc in await self._claim(capacity - claimed):
+                            self._submit(doc)
+                            claimed += 1
+                    except PyMongoError as e:
+                        logger.error("Could not claim outbox messages of %s: %s", bot.name, e)
+            if capacity > 0 and claimed == capacity:
+                # more may be ready, claim again once deliveries finish
+                continue
+            try:
+                await asyncio.wait_for(self._wake.wait(), OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _claim(self, limit: int) -> List[Dict[str, Any]]:
+        # buffered status updates of earlier messages must land before the claim
+        await writes.flush()
+        now = datetime.now(timezone.utc)
+        token = ObjectId()
+        ready = {'$or': [
+            {'status': PENDING, 'next_attempt_at': {'$lte': now}},
+            # the worker holding it died
+            {'status': SENDING, 'lease_until': {'$lt': now}}
+        ]}
+        ids = [d['_id'] async for d in db.outbox.find(ready, {'_id': 1}).sort('next_attempt_at', 1).limit(limit)]
+        if not ids:
+            return []
+        await db.outbox.update_many(
+            {'_id': {'$in': ids}, **ready},
+            {'$set': {'status': SENDING, 'lease_owner': WORKER_ID, 'lease_token': token, 'lease_until': now + OUTBOX_LEASE}}
+        )
+        claimed = await db.outbox.find({'_id': {'$in': ids}, 'lease_token': token}).to_list()
+        for doc in claimed:
+            self._in_flight[doc['_id']] = (bots.active().name, token)
+        return claimed
+
+    def _submit(self, doc: Dict[str, Any]):
+        # the callbacks run on a delivery worker, in the context of the pool
+        bot = bots.active()
+
+        async def on_sent(sent: Message):
+            with bots.use(bot):
+                self._sent(doc, sent)
+
+        async def on_failed(error: Exception):
+            with bots.use(bot):
+                self._done(doc)
+                self._failed(doc, error)
+
+        self._pool.submit(OutgoingMessage(
+            chat_id=doc['chat_id'],
+            text=doc['text'],
+            on_sent=on_sent,
+            on_failed=on_failed,
+            kwargs=doc.get('kwargs') or {},
+            bot=self._senders.get(bot.name)
+        ))
+
+    def _sent(self, doc: Dict[str, Any], sent: Message):
+        self._done(doc)
+        writes.update('outbox', {'_id': doc['_id'], 'lease_token': doc['lease_token']}, {
+            '$set': {'status': SENT, 'done_at': datetime.now(timezone.utc), 'message_id': sent.message_id},
+            '$unset': RELEASE
+        }, key=doc['_id'])
+        metrics.outbox_messages.inc(outcome="sent")
+        hook = self._on_sent.get(doc.get('kind'))
+        if hook:
+            hook(doc, sent)
+
+    def _failed(self, doc: Dict[str, Any], error: Exception):
+        attempts = doc.get('attempts', 0) + 1
+        update = {'attempts': attempts, 'last_error': f"{type(error).__name__}: {error}"}
+        # blocked by the user or chat gone: retrying can't help
+        if isinstance(error, (Forbidden, BadRequest)) or attempts >= self.max_attempts:
+            update.update(status=DEAD, done_at=datetime.now(timezone.utc))
+            metrics.outbox_messages.inc(outcome="dead")
+            logger.warning("Dead-lettered message %s after %d attempts: %s", doc['_id'], attempts, error)
+        else:
+            update.update(status=PENDING, next_attempt_at=datetime.now(timezone.utc) + timedelta(seconds=backoff(attempts)))
+            metrics.outbox_messages.inc(outcome="retried")
+        writes.update('outbox', {'_id': doc['_id'], 'lease_token': doc['lease_token']},
+                      {'$set': update, '$unset': RELEASE}, key=doc['_id'])
+
+    def _done(self, doc: Dict[str, Any]):
+        self._in_flight.pop(doc['_id'], None)
+        if self._wake and len(self._in_flight) <= self.batch // 2:
+            self._wake.set()
+
+
+outbox = Outbox()
@@ -0,0 +1,196 @@
+"""
+On-demand profiling: a sampling profiler of the event loop thread plus wall
+and event-loop blocking time per handler and job. Nothing is sampled or timed
+until start(), the wrappers then cost one attribute check per call.
+"""
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+PROFILE_INTERVAL = 0.005  # seconds between samples
+PROFILE_MAX_DEPTH = 64
+# the loop waits for I/O here, samples of it are counted as idle
+_IDLE = ('selectors.py', 'select')
+
+_Code = Tuple[str, str, int]  # file, function, first line
+
+
+class _Yield:
+    """ Passes a value yielded by a hand-driven coroutine on to the event loop """
+
+    def __init__(self, value):
+        self.value = value
+
+    def __await__(self):
+        return (yield self.value)
+
+
+async def drive(coro, record: Callable[[float], Any]):
+    """
+    Await coro stepping it by hand, record gets the time spent inside its steps:
+    how long it kept the event loop from running anything else.
+    """
+    blocking = 0.0
+    value, error = None, None
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                yielded = coro.throw(error) if error else coro.send(value)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                blocking += time.perf_counter() - start
+            try:
+                value, error = await _Yield(yielded), None
+            except BaseException as e:
+                value, error = None, e
+    finally:
+        record(blocking)
+
+
+class Profiler:
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self.active = False
+        self.started_at: Optional[float] = None
+        self.stopped_at: Optional[float] = None
+        self._thread: Optional[threading.Thread] = None
+        self._target: Optional[int] = None
+        # the sampling thread updates the counters while reports are made on the loop
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.samples = 0
+        self.idle = 0
+        self._self: Counter = Counter()
+        self._total: Counter = Counter()
+        self._stacks: Counter = Counter()
+        # name -> [calls, wall, blocking, max wall, max blocking]
+        self.timings: Dict[str, list] = {}
+
+    def start(self, interval: Optional[float] = None):
+        """ Start sampling the calling (event loop) thread and timing wrapped callbacks """
+        if self.active:
+            return
+        self._reset()
+        self.interval = interval or self.interval
+        self._target = threading.get_ident()
+        self.active = True
+        self.started_at, self.stopped_at = time.monotonic(), None
+        self._thread = threading.Thread(target=self._sample_loop, name="profiler", daemon=True)
+        self._thread.start()
+        logger.info("Profiler started, sampling every %.1fms", self.interval * 1000)
+
+    def stop(self):
+        if not self.active:
+            return
+        self.active = False
+        self.stopped_at = time.monotonic()
+        self._thread.join()
+        self._thread = None
+        logger.info("Profiler stopped after %d samples", self.samples)
+
+    def record(self, name: str, wall: float, blocking: float):
+        timing = self.timings.setdefault(name, [0, 0.0, 0.0, 0.0, 0.0])
+        timing[0] += 1
+        timing[1] += wall
+        timing[2] += blocking
+        timing[3] = max(timing[3], wall)
+        timing[4] = max(timing[4], blocking)
+
+    def _sample_loop(self):
+        while self.active:
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(self._target)
+            # not the stop() call itself
+            if frame is not None and self.active:
+                self._sample(frame)
+
+    def _sample(self, frame):
+        stack = []
+        while frame is not None and len(stack) < PROFILE_MAX_DEPTH:
+            code = frame.f_code
+            stack.append((os.path.basename(code.co_filename), code.co_name, code.co_firstlineno))
+            frame = frame.f_back
+        with self._lock:
+            self.samples += 1
+            if stack and stack[0][:2] == _IDLE:
+                self.idle += 1
+                return
+            self._self[stack[0]] += 1
+            for code in set(stack):
+                self._total[code] += 1
+            self._stacks[tuple(reversed(stack))] += 1
+
+    def report(self, top: int = 15) -> str:
+        """ Text report of the hot spots and the timings of the wrapped callbacks """
+        with self._lock:
+            return self._report(top)
+
+    def _report(self, top: int) -> str:
+        end = self.stopped_at or time.monotonic()
+        duration = end - self.started_at if self.started_at else 0.0
+        busy = self.samples - self.idle
+        lines = [
+            f"[PROFILE] {'running' if self.active else 'stopped'}, {duration:.1f}s, "
+            f"{self.samples} samples every {self.interval * 1000:.0f}ms, "
+            f"loop busy {busy / self.samples:.0%}" if self.samples else "[PROFILE] no samples"
+        ]
+        for title, counter in (("Self", self._self), ("Cumulative", self._total)):
+            if counter:
+                lines.append(f"\n{title} (share of busy samples):")
+                lines += [f"{n / busy:6.1%}  {_format(code)}" for code, n in counter.most_common(top)]
+        if self.timings:
+            lines.append("\nCallbacks: calls, wall avg/max ms, loop blocking avg/max ms")
+            for name, (calls, wall, blocking, max_wall, max_blocking) in sorted(
+                    self.timings.items(), key=lambda item: -item[1][2]):
+                lines.append(f"{name}: {calls}, {wall / calls * 1000:.1f}/{max_wall * 1000:.1f}, "
+                             f"{blocking / calls * 1000:.2f}/{max_blocking * 1000:.2f}")
+        return "\n".join(lines)
+
+    def collapsed(self) -> str:
+        """ Busy stacks in the collapsed format read by flamegraph.pl and speedscope """
+        with self._lock:
+            return "\n".join(f"{';'.join(_format(code) for code in stack)} {n}" for stack, n in self._stacks.most_common())
+
+
+def _format(code: _Code) -> str:
+    filename, name, line = code
+    return f"{name} ({filename}:{line})"
+
+
+def profiled(func: Callable, name: Optional[str] = None) -> Callable:
+    """ Wrap an async handler or job callback to be timed while the profiler runs """
+    name = name or func.__qualname__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        if not profiler.active:
+            return await func(*args, **kwargs)
+        start = time.perf_counter()
+        blocking = []
+        try:
+            return await drive(func(*args, **kwargs), blocking.append)
+        finally:
+            if profiler.active:
+                profiler.record(name, time.perf_counter() - start, blocking[0] if blocking else 0.0)
+    return wrapper
+
+
+def instrument(app):
+    """ Wrap the callbacks of all handlers registered on the application """
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            handler.callback = profiled(handler.callback)
+
+
+profiler = Profiler()
@@ -9,7 +9,12 @@ stats - Your statistics
 remove - Remove a reminder or all reminders
 help - Help
 """
+import asyncio
+import logging
 import os
+import secrets
+import signal
+from telegram import Update
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
@@ -20,16 +25,134 @@ from telegram.ext import (
 
 from . import utils
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
-utils.setup_logging(log_level=LOG_LEVEL, file_logger_names=["httpx"])
-from . import jobs, handlers, commands, debug
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+LOG_FILE = os.getenv("LOG_FILE")
+# per message template and minute, for info/debug messages logged per reminder or request
+LOG_RATE_LIMIT = int(os.getenv("LOG_RATE_LIMIT") or 60)
+utils.setup_logging(
+    log_level=LOG_LEVEL,
+    log_file=LOG_FILE,
+    file_logger_names=["httpx"],
+    json_format=LOG_FORMAT == "json",
+    rate_limit=LOG_RATE_LIMIT
+)
+from . import bots, jobs, handlers, commands, debug, ai, migrations, profiling
+from .db import db
+from .delivery import delivery
+from .outbox import outbox
+from .tzlookup import tz_resolver
+from .webserver import server, WebhookHandler
+from .writebehind import writes
 
-TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
-ENV = os.getenv("ENVIRONMENT")
-ADMIN_USER_ID = os.getenv("ADMIN_USER_ID")
+logger = logging.getLogger(__name__)
 
-def run():
-    """Setup and create the bot application."""
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+# the bots (tokens, databases, admins and webhook paths) are configured in bots
+# webhook mode is used when WEBHOOK_URL (public base URL) is set, else long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+# the HTTP server (webhook, /health, /ready, /metrics) runs in webhook mode or when
+# HTTP_PORT is set, and outside of webhook mode only listens on localhost by default
+HTTP_SERVER = bool(WEBHOOK_URL or os.getenv("HTTP_PORT"))
+HTTP_LISTEN = os.getenv("HTTP_LISTEN") or ("0.0.0.0" if WEBHOOK_URL else "127.0.0.1")
+HTTP_PORT = int(os.getenv("HTTP_PORT") or 8080)
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES") or 32)
+
+async def post_init(app):
+    """Connect to the database and start the reminder scheduler once the event loop runs."""
+    await startup({bots.active().name: app})
+
+
+async def startup(apps):
+    """Start the services shared by the applications (bot name -> Application), the first one's job queue runs the jobs."""
+    # serve /health and /ready while connecting
+    if HTTP_SERVER:
+        server.start(HTTP_LISTEN, HTTP_PORT)
+    if not await db.ping():
+        raise RuntimeError("MongoDB is not reachable")
+    for bot in bots.hosted():
+        with bots.use(bot):
+            await migrations.migrate()
+    primary = apps[bots.hosted()[0].name]
+    # wakes the reminder job when the next reminder is due
+    await jobs.start_scheduler(primary.job_queue)
+    primary.job_queue.run_repeating(profiling.profiled(jobs.pregenerate_job), interval=jobs.PREGEN_INTERVAL, first=0)
+    primary.job_queue.run_repeating(profiling.profiled(jobs.sync_job), interval=jobs.SYNC_INTERVAL)
+    delivery.start(primary.bot)
+    outbox.start(delivery, {name: app.bot for name, app in apps.items()})
+    server.status = "ready"
+
+
+async def post_stop(_app):
+    """Stop the HTTP server, delivery workers and outbox while the bots' HTTP clients are still open."""
+    server.status = "stopping"
+    await server.stop()
+    # no message is sent after the outbox handed back what is left
+    await delivery.stop()
+    await outbox.stop()
+    # writes of the last deliveries
+    await writes.close()
+
+
+async def post_shutdown(_app):
+    """Close the AI client and the timezone finder."""
+    await ai.close()
+    tz_resolver.close()
+
+
+async def serve(apps):
+    """
+    Run the applications (bot name -> Application) in this event loop until
+    SIGINT/SIGTERM, on webhooks served by the embedded HTTP server when
+    WEBHOOK_URL is set, else by long polling.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    configs = bots.hosted()
+    webhook_secrets = {}
+    if WEBHOOK_URL:
+        for config in configs:
+            # the webhook path is guessable, updates are only accepted with the secret token
+            webhook_secrets[config.name] = config.webhook_secret or secrets.token_urlsafe(32)
+            if not config.webhook_secret:
+                logger.warning("No webhook secret for bot %s, generated one for this process "
+                               "(set WEBHOOK_SECRET when running several replicas)", config.name)
+            server.add_route(config.webhook_path, WebhookHandler, bot_app=apps[config.name],
+                             secret_token=webhook_secrets[config.name])
+    for app in apps.values():
+        await app.initialize()
+    await startup(apps)
+    for config in configs:
+        app = apps[config.name]
+        # the application's tasks (and so its handlers) keep the bot active
+        with bots.use(config):
+            if WEBHOOK_URL:
+                await app.bot.set_webhook(
+                    url=WEBHOOK_URL.rstrip("/") + config.webhook_path,
+                    secret_token=webhook_secrets[config.name],
+                    allowed_updates=Update.ALL_TYPES
+                )
+            else:
+                await app.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+            await app.start()
+        logger.info("Started bot %s", config.name)
+    try:
+        await stop.wait()
+    finally:
+        for app in apps.values():
+            if app.updater and app.updater.running:
+                await app.updater.stop()
+            if app.running:
+                await app.stop()
+        await post_stop(None)
+        for app in apps.values():
+            await app.shutdown()
+        await post_shutdown(None)
+
+
+def add_handlers(app, config=None):
+    """Register the command, message and callback handlers, the admin ones for the admin of config (the active bot)."""
     app.add_handler(CommandHandler("start", commands.start))
     app.add_handler(CommandHandler("timezone", commands.settz))
     app.add_handler(CommandHandler("set", commands.set_reminder))
@@ -37,19 +160,44 @@ def run():
     app.add_handler(CommandHandler("remove", commands.remove_reminder))
     app.add_handler(CommandHandler("stats", commands.user_stats))
     app.add_handler(CommandHandler("help", commands.help_command))
-    if ADMIN_USER_ID:
-        app.add_handler(CommandHandler("info", debug.info, filters=filters.User(int(ADMIN_USER_ID))))
-        app.add_handler(CommandHandler("users", debug.user_list, filters=filters.User(int(ADMIN_USER_ID))))
-        app.add_handler(CommandHandler("sudolist", debug.sudo_list_reminders, filters=filters.User(int(ADMIN_USER_ID))))
+    admin_user_id = (config or bots.active()).admin_user_id
+    if admin_user_id:
+        app.add_handler(CommandHandler("info", debug.info, filters=filters.User(admin_user_id)))
+        app.add_handler(CommandHandler("users", debug.user_list, filters=filters.User(admin_user_id)))
+        app.add_handler(CommandHandler("sudolist", debug.sudo_list_reminders, filters=filters.User(admin_user_id)))
+        app.add_handler(CommandHandler("metrics", debug.metrics_summary, filters=filters.User(admin_user_id)))
+        app.add_handler(CommandHandler("profile", debug.profile, filters=filters.User(admin_user_id)))
+        app.add_handler(CommandHandler("export", debug.export, filters=filters.User(admin_user_id)))
     app.add_handler(MessageHandler(filters.PHOTO, handlers.handle_photo))
     app.add_handler(MessageHandler(filters.LOCATION, handlers.handle_location))
     app.add_handler(CallbackQueryHandler(handlers.handle_remove_callback, pattern="^remove:"))
     app.add_handler(CallbackQueryHandler(handlers.handle_sudolist_callback, pattern="^sudolist:"))
+    app.add_handler(CallbackQueryHandler(handlers.handle_users_callback, pattern="^users:"))
+
 
-    # Start reminder job - check every 30 seconds
-    app.job_queue.run_repeating(jobs.reminder_job, interval=30, first=0)
+def build(config, primary=True):
+    """Create the application of a bot, only the primary one has a job queue."""
+    builder = ApplicationBuilder().token(config.token)
+    if primary:
+        # run_polling calls post_stop before Application.shutdown() closes the bot
+        builder = builder.post_init(post_init).post_stop(post_stop).post_shutdown(post_shutdown)
+    else:
+        builder = builder.job_queue(None)
+    # in both modes, so one slow update does not hold up everybody else's
+    app = builder.concurrent_updates(CONCURRENT_UPDATES).build()
+    add_handlers(app, config)
+    # timed only while /profile runs
+    profiling.instrument(app)
+    return app
 
-    app.run_polling()
+
+def run():
+    """Setup and run the application of every hosted bot (see bots)."""
+    configs = bots.hosted()
+    if len(configs) == 1 and not WEBHOOK_URL:
+        build(configs[0]).run_polling()
+    else:
+        asyncio.run(serve({config.name: build(config, primary=i == 0) for i, config in enumerate(configs)}))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,285 @@
+import heapq
+import itertools
+import logging
+from dataclasses import dataclass
+from datetime import datetime, date, time, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from . import bots
+
+logger = logging.getLogger(__name__)
+
+# delay before an undelivered reminder is tried again
+RETRY_DELAY = timedelta(seconds=30)
+
+# user ids are only unique per bot
+_User = Tuple[str, int]
+
+
+def load_tz(tz_name: Optional[str]) -> Optional[ZoneInfo]:
+    """ ZoneInfo for tz_name or None if it is not set / invalid """
+    if not tz_name:
+        return None
+    try:
+        return ZoneInfo(tz_name)
+    except (ZoneInfoNotFoundError, ValueError) as e:
+        logger.error("Invalid timezone %s: %s", tz_name, e)
+        return None
+
+
+def next_fire_time(reminder_time: time, tz: ZoneInfo, last_sent_date: Optional[date],
+                   now: Optional[datetime] = None) -> datetime:
+    """
+    Next UTC instant a reminder is due: today's local HH:MM unless it was already
+    sent today, else tomorrow's. The result lies in the past when it is overdue.
+    """
+    now = now or datetime.now(timezone.utc)
+    today = now.astimezone(tz).date()
+    day = today + timedelta(days=1) if last_sent_date == today else today
+    # ZoneInfo resolves DST: a wall time inside a spring-forward gap maps to the
+    # shifted instant, an ambiguous one (fall-back) to its first occurrence
+    return datetime.combine(day, reminder_time, tzinfo=tz).astimezone(timezone.utc)
+
+
+@dataclass
+class _Entry:
+    reminder_id: Any
+    bot: str
+    user_id: int
+    time: time
+    last_sent_date: Optional[date]
+    fire_at: Optional[datetime] = None  # None while unscheduled or being delivered
+    due_at: Optional[datetime] = None  # the instant it is due, kept while it is retried
+    seq: int = 0
+
+
+class ReminderScheduler:
+    """
+    Keeps every reminder in a min-heap keyed on its next UTC fire instant and wakes
+    the reminder job (through the job queue) exactly when the earliest one is due.
+    Stale heap items are skipped lazily instead of being removed in place.
+    One scheduler serves all hosted bots: reminders and users belong to the
+    bot active when they were added.
+    """
+
+    def __init__(self):
+        self._heap: List[tuple] = []
+        self._entries: Dict[Any, _Entry] = {}
+        self._by_user: Dict[_User, set] = {}
+        self._tz: Dict[_User, Optional[ZoneInfo]] = {}
+        self._in_flight: set = set()
+        self._seq = itertools.count()
+        self._job_queue = None
+        self._callback = None
+        self._job = None
+        self._armed_at: Optional[datetime] = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, reminder_id: Any) -> bool:
+        return reminder_id in self._entries
+
+    def attach(self, job_queue, callback):
+        """ Wake callback through job_queue whenever the next reminder is due """
+        self._job_queue = job_queue
+        self._callback = callback
+        self.rearm()
+
+    def load(self, reminders: Iterable[Dict[str, Any]], timezones: Dict[int, Optional[str]]):
+        """ Bulk (re)build the active bot's reminders from documents and a user_id -> tz name map """
+        bot = bots.active().name
+        for entry in [e for e in self._entries.values() if e.bot == bot]:
+            self._discard(entry.reminder_id)
+        self._tz = {user: tz for user, tz in self._tz.items() if user[0] != bot}
+        self._tz.update(((bot, user_id), load_tz(tz_name)) for user_id, tz_name in timezones.items())
+        # keep the other bots' live items only, the new ones are appended unordered
+        self._heap = [item for item in self._heap if self._live(item)]
+        count = len(self._entries)
+        for r in reminders:
+            self._add(r)
+        heapq.heapify(self._heap)
+        logger.info("Scheduler loaded %d reminders of %s", len(self._entries) - count, bot)
+        self.rearm()
+
+    def add(self, reminder: Dict[str, Any], tz_name: Optional[str] = None):
+        """ Schedule a new (or changed) reminder document """
+        if tz_name is not None:
+            self._tz[self._user(reminder['user_id'])] = load_tz(tz_name)
+        self._add(reminder, push=True)
+        self.rearm()
+
+    def bot_of(self, reminder_id: Any) -> Optional[str]:
+        """ Name of the bot the reminder belongs to """
+        entry = self._entries.get(reminder_id)
+        return entry.bot if entry else None
+
+    def user_of(self, reminder_id: Any) -> Optional[int]:
+        """ Id of the user the reminder belongs to """
+        entry = self._entries.get(reminder_id)
+        return entry.user_id if entry else None
+
+    def remove(self, reminder_id: Any):
+        if self._discard(reminder_id):
+            self.rearm()
+
+    def remove_user(self, user_id: int):
+        for reminder_id in self._by_user.pop(self._user(user_id), set()):
+            self._entries.pop(reminder_id, None)
+            self._in_flight.discard(reminder_id)
+        self.rearm()
+
+    def set_timezone(self, user_id: int, tz_name: Optional[str]):
+        """ Recompute fire instants of all the user's reminders for a new timezone """
+        user = self._user(user_id)
+        tz = load_tz(tz_name)
+        if tz is not None and self._tz.get(user) == tz:
+            return
+        self._tz[user] = tz
+        for reminder_id in self._by_user.get(user, ()):
+            if tz is None:
+                # nothing to deliver until a timezone is set again
+                self._in_flight.discard(reminder_id)
+            if reminder_id not in self._in_flight:
+                self._schedule(self._entries[reminder_id])
+        self.rearm()
+
+    def mark_sent(self, reminder_id: Any, sent_date: date):
+        """ Reminder was delivered on sent_date (user's local date): due again tomorrow """
+        self._in_flight.discard(reminder_id)
+        entry = self._entries.get(reminder_id)
+        if entry:
+            entry.last_sent_date = sent_date
+            self._schedule(entry)
+
+    def retry(self, reminder_id: Any, delay: timedelta = RETRY_DELAY):
+        self._in_flight.discard(reminder_id)
+        entry = self._entries.get(reminder_id)
+        if entry:
+            self._push(entry, datetime.now(timezone.utc) + delay)
+
+    def release(self, reminder_ids: Iterable[Any]):
+        """ Retry popped reminders that were neither marked sent nor retried """
+        for reminder_id in reminder_ids:
+            if reminder_id in self._in_flight:
+                self.retry(reminder_id)
+
+    def pop_due(self, now: Optional[datetime] = None) -> Dict[Any, datetime]:
+        """ Remove all reminders due at now (UTC), returns their ids and the (UTC) instants they were due """
+        now = now or datetime.now(timezone.utc)
+        # the wake-up job is firing, it must not be cancelled on rearm
+        self._job = None
+        self._armed_at = None
+        due = {}
+        while self._heap and self._heap[0][0] <= now:
+            fire_at, seq, reminder_id = heapq.heappop(self._heap)
+            entry = self._entries.get(reminder_id)
+            if entry and entry.seq == seq and entry.fire_at is not None:
+                entry.fire_at = None
+                self._in_flight.add(reminder_id)
+                # a retried reminder fires later (maybe the next day) but is still due on its own day
+                due[reminder_id] = entry.due_at or fire_at
+        return due
+
+    def upcoming(self, until: datetime) -> List[tuple]:
+        """ (reminder_id, local fire datetime) of scheduled reminders firing up to until (UTC) """
+        result = []
+        # only walk the part of the heap that fires before until
+        stack = [0]
+        while stack:
+            i = stack.pop()
+            if i >= len(self._heap) or self._heap[i][0] > until:
+                continue
+            fire_at, seq, reminder_id = self._heap[i]
+            entry = self._entries.get(reminder_id)
+            if entry and entry.seq == seq and entry.fire_at is not None:
+                result.append((reminder_id, fire_at.astimezone(self._tz[(entry.bot, entry.user_id)])))
+            stack.extend((2 * i + 1, 2 * i + 2))
+        return result
+
+    def next_fire(self) -> Optional[datetime]:
+        """ Earliest scheduled fire instant (UTC) """
+        while self._heap:
+            if self._live(self._heap[0]):
+                return self._heap[0][0]
+            heapq.heappop(self._heap)
+        return None
+
+    def _live(self, item: tuple) -> bool:
+        _, seq, reminder_id = item
+        entry = self._entries.get(reminder_id)
+        return bool(entry and entry.seq == seq and entry.fire_at is not None)
+
+    @staticmethod
+    def _user(user_id: int) -> _User:
+        return bots.active().name, user_id
+
+    def rearm(self):
+        """ Move the wake-up job to the earliest fire instant """
+        if not self._job_queue:
+            return
+        fire_at = self.next_fire()
+        if fire_at == self._armed_at and self._job:
+            return
+        if self._job:
+            self._job.schedule_removal()
+            self._job = None
+        self._armed_at = fire_at
+        if fire_at is not None:
+            when = max(fire_at, datetime.now(timezone.utc))
+            self._job = self._job_queue.run_once(self._callback, when=when, name="reminder_job")
+
+    def _add(self, reminder: Dict[str, Any], push: bool = False):
+        reminder_id = reminder['_id']
+        user_id = reminder.get('user_id')
+        try:
+            reminder_time = datetime.strptime(reminder.get('time') or "", "%H:%M").time()
+        except ValueError:
+            logger.error("Invalid reminder_time for reminder %s: %s", reminder_id, reminder.get('time'))
+            return
+        last_sent_date = None
+        if reminder.get('last_sent_date'):
+            try:
+                last_sent_date = datetime.strptime(reminder['last_sent_date'], "%Y-%m-%d").date()
+            except ValueError:
+                logger.error("Invalid last_sent_date for reminder %s: %s", reminder_id, reminder['last_sent_date'])
+
+        self._discard(reminder_id)
+        entry = _Entry(reminder_id, bots.active().name, user_id, reminder_time, last_sent_date)
+        self._entries[reminder_id] = entry
+        self._by_user.setdefault((entry.bot, user_id), set()).add(reminder_id)
+        self._schedule(entry, push=push)
+
+    def _discard(self, reminder_id: Any) -> bool:
+        entry = self._entries.pop(reminder_id, None)
+        self._in_flight.discard(reminder_id)
+        if not entry:
+            return False
+        self._by_user.get((entry.bot, entry.user_id), set()).discard(reminder_id)
+        return True
+
+    def _schedule(self, entry: _Entry, push: bool = True):
+        tz = self._tz.get((entry.bot, entry.user_id))
+        if not tz:
+            logger.warning("No timezone set for user %s, not scheduling reminder %s",
+                           entry.user_id, entry.reminder_id)
+            entry.fire_at = None
+            entry.seq = next(self._seq)
+            return
+        fire_at = next_fire_time(entry.time, tz, entry.last_sent_date)
+        entry.due_at = fire_at
+        if push:
+            self._push(entry, fire_at)
+        else:
+            entry.fire_at = fire_at
+            entry.seq = next(self._seq)
+            self._heap.append((fire_at, entry.seq, entry.reminder_id))
+
+    def _push(self, entry: _Entry, fire_at: datetime):
+        entry.fire_at = fire_at
+        entry.seq = next(self._seq)
+        heapq.heappush(self._heap, (fire_at, entry.seq, entry.reminder_id))
+
+
+scheduler = ReminderScheduler()
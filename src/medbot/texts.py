@@ -0,0 +1,61 @@
+import logging
+import os
+from datetime import date, datetime, timezone
+from typing import Any, Dict, Iterable
+
+from .cache import TTLCache
+from .db import db
+
+logger = logging.getLogger(__name__)
+
+# also keep pre-generated texts in Mongo so they survive restarts
+PERSIST_AI_TEXTS = os.getenv('PERSIST_AI_TEXTS', '').lower() in ('1', 'true', 'yes')
+TEXT_CACHE_SIZE = 100000
+TEXT_CACHE_TTL = 24 * 3600  # seconds
+
+
+class ReminderTexts:
+    """
+    Pre-generated reminder texts keyed on (reminder id, local date), held in an
+    in-memory TTL/LRU cache and optionally persisted in the texts collection.
+    """
+
+    def __init__(self, persist: bool = PERSIST_AI_TEXTS):
+        self.persist = persist
+        self.cache = TTLCache(TEXT_CACHE_SIZE, TEXT_CACHE_TTL)
+
+    @staticmethod
+    def key(reminder_id: Any, day: date) -> str:
+        return f"{reminder_id}:{day.isoformat()}"
+
+    async def get_many(self, keys: Iterable[str]) -> Dict[str, str]:
+        """ Cached texts for the keys that have one """
+        found = {}
+        missing = []
+        for key in keys:
+            text = self.cache.get(key)
+            if text is None:
+                missing.append(key)
+            else:
+                found[key] = text
+        if self.persist and missing:
+            async for doc in db.texts.find({'_id': {'$in': missing}}):
+                self.cache.set(doc['_id'], doc['text'])
+                found[doc['_id']] = doc['text']
+        return found
+
+    def skip(self, key: str):
+        """ Remember that the key gets no AI text (the default one is sent), in memory only """
+        self.cache.set(key, "")
+
+    async def put(self, key: str, text: str):
+        self.cache.set(key, text)
+        if self.persist:
+            await db.texts.update_one(
+                {'_id': key},
+                {'$set': {'text': text, 'created_at': datetime.now(timezone.utc)}},
+                upsert=True
+            )
+
+
+texts = ReminderTexts()
@@ -0,0 +1,85 @@
+"""
+Coordinates -> IANA timezone lookups off the event loop. The finder (and its
+boundary data) is only loaded on the first lookup, results are memoized per
+quantized coordinate so repeated shares from the same city skip the lookup.
+"""
+import asyncio
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+from .cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# lookups running or waiting for the executor, more wait on the event loop
+TZ_LOOKUP_CONCURRENCY = int(os.getenv('TZ_LOOKUP_CONCURRENCY') or 4)
+# 2 decimals ~ 1 km, well below the size of any timezone area
+TZ_PRECISION = 2
+TZ_CACHE_SIZE = 50000
+TZ_CACHE_TTL = 7 * 86400
+
+_UNKNOWN = object()
+
+
+class TimezoneResolver:
+    def __init__(self, concurrency: int = TZ_LOOKUP_CONCURRENCY):
+        self.concurrency = concurrency
+        self._cache = TTLCache(TZ_CACHE_SIZE, TZ_CACHE_TTL)
+        # identical lookups in flight share one future
+        self._pending: Dict[Tuple[float, float], asyncio.Future] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        # a single thread: the finder is not documented as thread-safe
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._finder = None
+        self._finder_lock = threading.Lock()
+
+    @staticmethod
+    def key(lat: float, lng: float) -> Tuple[float, float]:
+        return round(lat, TZ_PRECISION), round(lng, TZ_PRECISION)
+
+    async def timezone_at(self, lat: float, lng: float) -> Optional[str]:
+        """ IANA timezone name at the coordinates, None over the open sea or on errors """
+        key = self.key(lat, lng)
+        tz_name = self._cache.get(key, _UNKNOWN)
+        if tz_name is not _UNKNOWN:
+            return tz_name
+        future = self._pending.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._resolve(key))
+            self._pending[key] = future
+            future.add_done_callback(lambda _f: self._pending.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def _resolve(self, key: Tuple[float, float]) -> Optional[str]:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tzlookup")
+        async with self._semaphore:
+            try:
+                tz_name = await asyncio.get_running_loop().run_in_executor(self._executor, self._lookup, *key)
+            except Exception as e:
+                logger.error("Timezone lookup for %s failed: %s", key, e)
+                return None
+        self._cache.set(key, tz_name)
+        return tz_name
+
+    def _lookup(self, lat: float, lng: float) -> Optional[str]:
+        if self._finder is None:
+            with self._finder_lock:
+                if self._finder is None:
+                    from timezonefinder import TimezoneFinder
+                    self._finder = TimezoneFinder()
+                    logger.info("Loaded timezone finder")
+        return self._finder.timezone_at(lat=lat, lng=lng)
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        self._semaphore = None
+
+
+tz_resolver = TimezoneResolver()
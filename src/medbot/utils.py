@@ -1,6 +1,15 @@
+import atexit
+import json
 import logging
+import logging.handlers
+import queue
 import sys
-from typing import Optional
+import threading
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
 
 
 class LoggerNameFilter(logging.Filter):
@@ -16,14 +25,83 @@ class LoggerNameFilter(logging.Filter):
         return not record.name.startswith(self.allowed)
 
 
+class RateLimitFilter(logging.Filter):
+    """
+    Lets at most limit records of the same message template (per logger and level)
+    through every interval seconds, the first one of the next interval reports how
+    many were dropped. Records at or above max_level always pass.
+    """
+    def __init__(self, limit: int, interval: float = 60.0, max_level: int = logging.WARNING):
+        super().__init__()
+        self.limit = limit
+        self.interval = interval
+        self.max_level = max_level
+        # template key -> [interval start, passed, suppressed]
+        self._windows: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= self.max_level:
+            return True
+        key = (record.name, record.levelno, record.msg if isinstance(record.msg, str) else type(record.msg))
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or record.created - window[0] >= self.interval:
+                if window and window[2]:
+                    record.msg = f"{record.msg} (+{window[2]} similar suppressed)"
+                if len(self._windows) > 10000:
+                    self._windows.clear()
+                window = self._windows[key] = [record.created, 0, 0]
+            if window[1] >= self.limit:
+                window[2] += 1
+                return False
+            window[1] += 1
+            return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, for log collectors."""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry['stack_info'] = self.formatStack(record.stack_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Only merges the message arguments on the calling thread, the listener formats."""
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # arguments may be mutated after the call returns
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
 def setup_logging(
     log_level=logging.INFO,
     log_file: Optional[str] = None,
-    file_logger_names: Optional[list[str]] = None
+    file_logger_names: Optional[list[str]] = None,
+    json_format: bool = False,
+    rate_limit: int = 0,
+    max_bytes: int = LOG_MAX_BYTES,
+    backup_count: int = LOG_BACKUP_COUNT,
+    stream=None
 ):
     """Configure logging for the entire package.
     If file_logger_names is provided, only loggers whose name starts with
     one of those prefixes will be written to the file.
+    Records are handed to a queue and formatted and written by a background
+    thread, so logging never blocks the event loop on I/O. The log file is
+    rotated at max_bytes. With rate_limit, at most that many records per
+    minute of each info/debug message template are kept. Console output goes
+    to stream, stdout by default.
     """
     # Create a root logger
     logger = logging.getLogger()
@@ -34,25 +112,38 @@ def setup_logging(
         return logger
 
     # Formatter
-    formatter = logging.Formatter(
-        fmt="%(asctime)s - %(name)s [%(levelname)s]: %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S"
-    )
+    if json_format:
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(
+            fmt="%(asctime)s - %(name)s [%(levelname)s]: %(message)s",
+            datefmt="%Y-%m-%d %H:%M:%S"
+        )
 
     # log filter
     logger_filter = LoggerNameFilter(file_logger_names)
 
     # Log to stdout
-    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler = logging.StreamHandler(stream or sys.stdout)
     stream_handler.setFormatter(formatter)
     stream_handler.addFilter(logger_filter)
-    logger.addHandler(stream_handler)
+    handlers = [stream_handler]
 
     # Optional log to file
     if log_file:
-        file_handler = logging.FileHandler(log_file)
+        file_handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count)
         file_handler.setFormatter(formatter)
         file_handler.addFilter(logger_filter)
-        logger.addHandler(file_handler)
+        handlers.append(file_handler)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _QueueHandler(log_queue)
+    if rate_limit:
+        queue_handler.addFilter(RateLimitFilter(rate_limit))
+    logger.addHandler(queue_handler)
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # write out what is still queued on exit
+    atexit.register(listener.stop)
 
     return logger
@@ -0,0 +1,93 @@
+import json
+import logging
+import secrets
+from typing import Optional
+
+import tornado.web
+from tornado.httpserver import HTTPServer
+from telegram import Update
+from telegram.ext import Application
+
+from .metrics import registry
+
+logger = logging.getLogger(__name__)
+
+
+class HealthHandler(tornado.web.RequestHandler):
+    """ Liveness probe for load balancers and container health checks """
+
+    def get(self):
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps({"status": "ok"}))
+
+
+class ReadyHandler(tornado.web.RequestHandler):
+    """ Readiness probe: 200 once startup finished, 503 while starting or stopping """
+
+    def initialize(self, web_server: "WebServer"):
+        self.web_server = web_server
+
+    def get(self):
+        self.set_header("Content-Type", "application/json")
+        if self.web_server.status != "ready":
+            self.set_status(503)
+        self.write(json.dumps({"status": self.web_server.status}))
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """ Metrics in the Prometheus text format """
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(registry.expose())
+
+
+class WebhookHandler(tornado.web.RequestHandler):
+    """ Receives updates pushed by Telegram and queues them on the application, only with the secret token """
+
+    def initialize(self, bot_app: Application, secret_token: str):
+        self.bot_app = bot_app
+        self.secret_token = secret_token
+
+    async def post(self):
+        received = self.request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not self.secret_token or not secrets.compare_digest(received, self.secret_token):
+            logger.warning("Webhook request with invalid secret token from %s", self.request.remote_ip)
+            raise tornado.web.HTTPError(403)
+        try:
+            update = Update.de_json(json.loads(self.request.body), self.bot_app.bot)
+        except ValueError as e:
+            logger.error("Invalid webhook payload: %s", e)
+            raise tornado.web.HTTPError(400)
+        await self.bot_app.update_queue.put(update)
+        self.set_status(200)
+
+
+class WebServer:
+    """ Embedded HTTP server for the webhook and operational endpoints """
+
+    def __init__(self):
+        self._routes: list = [
+            (r"/health", HealthHandler),
+            (r"/ready", ReadyHandler, {"web_server": self}),
+            (r"/metrics", MetricsHandler),
+        ]
+        self._server: Optional[HTTPServer] = None
+        # starting -> ready -> stopping, reported by /ready
+        self.status = "starting"
+
+    def add_route(self, path: str, handler, **kwargs):
+        self._routes.append((path, handler, kwargs))
+
+    def start(self, listen: str, port: int):
+        self._server = tornado.web.Application(self._routes).listen(port, address=listen)
+        logger.info("HTTP server listening on %s:%d", listen, port)
+
+    async def stop(self):
+        if self._server:
+            self._server.stop()
+            await self._server.close_all_connections()
+            self._server = None
+
+
+server = WebServer()
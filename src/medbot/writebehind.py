@@ -0,0 +1,158 @@
+"""
+Write-behind buffer for the per-message writes of the delivery path (lease
+releases, confirmations, events and stats rollups). Writes are collected and
+sent as unordered bulk_writes when WRITE_BEHIND_SIZE are pending or
+WRITE_BEHIND_INTERVAL after the first one, so sending a message no longer
+waits on its own Mongo round-trip.
+
+Reads that must see the buffered state await flush() first. Writes go to the
+database of the bot that was active when they were buffered.
+"""
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from . import metrics
+from .db import db
+
+logger = logging.getLogger(__name__)
+
+WRITE_BEHIND_SIZE = 500
+WRITE_BEHIND_INTERVAL = 0.5  # seconds
+# writes kept while Mongo is unreachable, the oldest are dropped beyond
+MAX_PENDING = 100000
+
+# (database, collection name, document key) -> write
+_Segment = Dict[Tuple[str, str, Hashable], Any]
+
+
+class WriteBehind:
+    """
+    Buffered writes are grouped in segments holding at most one write per
+    document. A second write to the same document starts a new segment and
+    segments are flushed one after the other, so writes to one document keep
+    their order although each bulk_write is unordered.
+    """
+
+    def __init__(self, max_size: int = WRITE_BEHIND_SIZE, interval: float = WRITE_BEHIND_INTERVAL):
+        self.max_size = max_size
+        self.interval = interval
+        self._segments: List[_Segment] = []
+        self._size = 0
+        self._timer = None
+        self._flushing: Optional[asyncio.Task] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._inserts = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def update(self, collection: str, filter: Dict[str, Any], update: Dict[str, Any],
+               key: Optional[Hashable] = None, upsert: bool = False):
+        """ Buffer an update_one, key identifies the document (defaults to the filter's _id) """
+        key = filter.get('_id') if key is None else key
+        self._add(collection, key, UpdateOne(filter, update, upsert=upsert))
+
+    def insert(self, collection: str, document: Dict[str, Any]):
+        # inserts never conflict with another buffered write
+        self._inserts += 1
+        self._add(collection, ('insert', self._inserts), InsertOne(document))
+
+    def _add(self, collection: str, key: Hashable, op: Any):
+        key = (db.namespace, collection, key)
+        if not self._segments or key in self._segments[-1]:
+            self._segments.append({})
+        self._segments[-1][key] = op
+        self._size += 1
+        metrics.write_behind_pending.set(self._size)
+        if self._size >= self.max_size:
+            self._schedule(0)
+        elif self._timer is None:
+            self._schedule(self.interval)
+
+    def _schedule(self, delay: float):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(delay, self._flush_soon)
+
+    def _flush_soon(self):
+        self._timer = None
+        if self._flushing is None or self._flushing.done():
+            self._flushing = asyncio.create_task(self._flush_logged())
+
+    async def _flush_logged(self):
+        try:
+            await self.flush()
+        except PyMongoError:
+            # kept for the next flush, already logged
+            if self._size and self._timer is None:
+                self._schedule(self.interval)
+
+    async def flush(self):
+        """ Write everything buffered so far, also waiting for a flush already running """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while self._segments:
+                segment = self._segments.pop(0)
+                failed, error = await self._write(segment)
+                self._size -= len(segment) - len(failed)
+                metrics.write_behind_pending.set(self._size)
+                if error:
+                    logger.error("Buffered writes failed, %d kept for retry: %s", self._size, error)
+                    self._segments.insert(0, failed)
+                    self._trim()
+                    raise error
+
+    async def close(self):
+        """ Flush on shutdown """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._size:
+            logger.info("Flushing %d buffered writes", self._size)
+            try:
+                await self.flush()
+            except PyMongoError:
+                logger.error("Dropped %d buffered writes on shutdown", self._size)
+
+    async def _write(self, segment: _Segment) -> Tuple[_Segment, Optional[Exception]]:
+        """ Bulk write the segment per collection, returns the writes to retry and the error """
+        by_collection = defaultdict(list)
+        for (namespace, collection, _key), op in segment.items():
+            by_collection[(namespace, collection)].append(op)
+        results = await asyncio.gather(
+            *(db.collection(collection, namespace).bulk_write(ops, ordered=False)
+              for (namespace, collection), ops in by_collection.items()),
+            return_exceptions=True
+        )
+        failed, error = {}, None
+        for (namespace, collection), result in zip(by_collection, results):
+            ops = by_collection[(namespace, collection)]
+            if isinstance(result, BulkWriteError):
+                # unordered: the other writes were applied, retrying would not fix these
+                errors = result.details.get('writeErrors', [])
+                logger.error("%d buffered writes to %s.%s failed: %s", len(errors), namespace, collection, errors[:3])
+            elif isinstance(result, PyMongoError):
+                # e.g. connection errors: retry the whole collection's writes (at least once)
+                failed.update((key, op) for key, op in segment.items() if key[:2] == (namespace, collection))
+                error = result
+                continue
+            elif isinstance(result, Exception):
+                logger.error("Dropped %d buffered writes to %s.%s: %r", len(ops), namespace, collection, result)
+                continue
+            metrics.write_behind_flushed.inc(len(ops), collection=collection)
+        return failed, error
+
+    def _trim(self):
+        while self._size > MAX_PENDING and len(self._segments) > 1:
+            dropped = self._segments.pop(0)
+            self._size -= len(dropped)
+            logger.error("Dropped %d buffered writes, Mongo unreachable", len(dropped))
+
+
+writes = WriteBehind()
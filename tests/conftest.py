@@ -0,0 +1,22 @@
+import os
+
+import pytest
+
+# one bot configured from the environment, its database named after ENVIRONMENT
+os.environ.pop('BOTS_CONFIG', None)
+os.environ.setdefault('ENVIRONMENT', 'test')
+
+
+@pytest.fixture
+def memory_db():
+    """ The db singleton connected to a fresh in-memory Mongo """
+    pytest.importorskip("mongomock")
+    from memory_mongo import MemoryClient
+    from medbot.db import db
+
+    client = db.client
+    db.connect(MemoryClient())
+    yield db
+    db.client = client
+    db._collections.clear()
+    db.profiles.clear()
@@ -0,0 +1,27 @@
+import json
+
+from medbot.ai import _parse_batch
+
+
+def test_parse_batch():
+    assert _parse_batch(json.dumps(["one", " two "]), 2) == ["one", "two"]
+
+
+def test_parse_batch_code_fence():
+    assert _parse_batch('```json\n["one", "two"]\n```', 2) == ["one", "two"]
+
+
+def test_parse_batch_blank_items():
+    assert _parse_batch(json.dumps(["one", " ", None]), 3) == ["one", None, None]
+
+
+def test_parse_batch_wrong_length():
+    # a missing message must not shift the others onto the wrong requests
+    assert _parse_batch(json.dumps(["one", "two"]), 3) == [None, None, None]
+    assert _parse_batch(json.dumps(["one", "two", "three"]), 2) == [None, None]
+
+
+def test_parse_batch_invalid():
+    assert _parse_batch("Sure! Here are your messages", 2) == [None, None]
+    assert _parse_batch(json.dumps({"0": "one"}), 1) == [None]
+    assert _parse_batch(None, 1) == [None]
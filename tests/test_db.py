@@ -0,0 +1,30 @@
+import asyncio
+
+
+def test_get_users_page(memory_db):
+    async def pages():
+        for user_id in [5, 1, 4, 2, 3]:
+            await memory_db.users.insert_one({'user_id': user_id, 'first_name': f"user{user_id}"})
+
+        def ids(page):
+            users, has_prev, has_next = page
+            return [u['user_id'] for u in users], has_prev, has_next
+
+        projection = {'user_id': 1, '_id': 0}
+        assert ids(await memory_db.get_users_page(limit=2, projection=projection)) == ([1, 2], False, True)
+        assert ids(await memory_db.get_users_page(after=2, limit=2)) == ([3, 4], True, True)
+        assert ids(await memory_db.get_users_page(after=4, limit=2)) == ([5], True, False)
+        assert ids(await memory_db.get_users_page(before=5, limit=2)) == ([3, 4], True, True)
+        assert ids(await memory_db.get_users_page(before=3, limit=2)) == ([1, 2], False, True)
+        assert ids(await memory_db.get_users_page(after=5, limit=2)) == ([], True, False)
+
+    asyncio.run(pages())
+
+
+def test_get_users_page_projection(memory_db):
+    async def page():
+        await memory_db.users.insert_one({'user_id': 1, 'first_name': "Ann", 'tz': "UTC"})
+        users, _, _ = await memory_db.get_users_page(projection={'user_id': 1, '_id': 0})
+        assert users == [{'user_id': 1}]
+
+    asyncio.run(page())
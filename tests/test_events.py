@@ -0,0 +1,42 @@
+import asyncio
+from datetime import date
+
+from medbot import events
+from medbot.writebehind import writes
+
+
+def test_week_key():
+    assert events.week_key(date(2024, 12, 30)) == "2025-W01"
+    assert events.week_key(date(2024, 5, 10)) == "2024-W19"
+
+
+def test_rollups(memory_db):
+    reminder = {'_id': "r1", 'user_id': 1, 'name': "pill"}
+    other = {'_id': "r2", 'user_id': 1, 'name': "vitamin"}
+
+    async def record():
+        try:
+            await events.reminder_added(reminder)
+            await events.reminder_added(other)
+            events.record_sent(reminder, date(2024, 5, 9))
+            events.record_confirmed(reminder, date(2024, 5, 9), 4)
+            events.record_sent(reminder, date(2024, 5, 13))
+            events.record_sent(other, date(2024, 5, 13))
+            events.record_confirmed(other, date(2024, 5, 13), 1)
+            await events.reminders_removed(1, ["r2"])
+            # reads what is still buffered
+            stats = await events.get_stats(1)
+            return stats, await memory_db.events.count_documents({'meta.user_id': 1}), await events.get_stats(2)
+        finally:
+            await writes.close()
+
+    stats, logged, nobody = asyncio.run(record())
+    assert (stats['sent'], stats['confirmed'], stats['longest_streak']) == (3, 2, 4)
+    assert stats['weekly'] == {
+        "2024-W19": {'sent': 1, 'confirmed': 1},
+        "2024-W20": {'sent': 2, 'confirmed': 1},
+    }
+    assert stats['reminders']["r1"] == {'name': "pill", 'sent': 2, 'confirmed': 1, 'streak': 4, 'longest_streak': 4}
+    assert stats['reminders']["r2"]['removed'] is True
+    assert logged == 5
+    assert nobody == {}
@@ -0,0 +1,50 @@
+import asyncio
+import gzip
+import io
+import json
+from datetime import datetime, timezone
+
+from bson import ObjectId
+
+from medbot import export
+
+
+def test_csv_header_comes_with_the_first_batch_only():
+    encoder = export._Encoder(['user_id', 'meta.type', 'ts'], 'csv')
+    ts = datetime(2024, 5, 10, 8, 0, tzinfo=timezone.utc)
+    first = encoder.encode([{'user_id': 1, 'meta': {'type': "sent"}, 'ts': ts}])
+    second = encoder.encode([{'user_id': 2}])
+    assert first.decode().splitlines() == ["user_id,meta.type,ts", "1,sent,2024-05-10T08:00:00+00:00"]
+    assert second.decode().splitlines() == ["2,,"]
+
+
+def test_jsonl():
+    oid = ObjectId()
+    encoder = export._Encoder(['_id', 'name', 'meta.user_id'], 'jsonl')
+    lines = encoder.encode([{'_id': oid, 'name': "Ibuprofen ✓", 'meta': {'user_id': 1}}, {'_id': oid}])
+    assert [json.loads(line) for line in lines.decode().splitlines()] == [
+        {'_id': str(oid), 'name': "Ibuprofen ✓", 'meta.user_id': 1},
+        {'_id': str(oid), 'name': None, 'meta.user_id': None},
+    ]
+
+
+def test_export_in_batches(memory_db):
+    async def run():
+        await memory_db.reminders.insert_many(
+            [{'user_id': i % 2, 'name': f"pill{i}", 'time': "08:00", 'secret': "x"} for i in range(5)]
+        )
+        out = io.BytesIO()
+        count = await export.export(out, 'reminders', 'jsonl', compress=True,
+                                    query=export.user_query('reminders', 1), batch_size=1)
+        return count, [json.loads(line) for line in gzip.decompress(out.getvalue()).splitlines()]
+
+    count, rows = asyncio.run(run())
+    assert count == 2
+    assert [row['name'] for row in rows] == ["pill1", "pill3"]
+    assert set(rows[0]) == set(export.EXPORTS['reminders'])
+
+
+def test_empty_csv_export_has_a_header(memory_db):
+    out = io.BytesIO()
+    assert asyncio.run(export.export(out, 'users')) == 0
+    assert out.getvalue().decode().strip() == ",".join(export.EXPORTS['users'])
@@ -0,0 +1,81 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+from medbot import jobs
+from medbot.scheduler import scheduler
+from medbot.writebehind import writes
+
+BERLIN = ZoneInfo("Europe/Berlin")
+
+
+def enqueue_due(memory_db, last_sent_date, due):
+    """ Outbox documents of the reminder 'r' (due at 23:58 Berlin time) enqueued for due """
+    reminder = {'_id': 'r', 'user_id': 1, 'name': "pill", 'time': "23:58",
+                'tz': "Europe/Berlin", 'last_sent_date': last_sent_date}
+
+    async def run():
+        await memory_db.reminders.insert_one(dict(reminder))
+        scheduler.add(reminder, "Europe/Berlin")
+        submitted = set()
+        try:
+            await jobs._enqueue_due({'r': due.astimezone(timezone.utc)}, submitted)
+            await writes.close()
+        finally:
+            scheduler.remove('r')
+        return submitted, await memory_db.outbox.find({}).to_list()
+
+    return asyncio.run(run())
+
+
+def test_reminder_retried_after_midnight_is_not_sent_again(memory_db):
+    # delivered on the 10th by another process, this one checks again at 00:03 on the 11th
+    due = datetime(2024, 5, 10, 23, 58, tzinfo=BERLIN)
+    submitted, messages = enqueue_due(memory_db, "2024-05-10", due)
+    assert submitted == set()
+    assert messages == []
+
+
+def test_reminder_is_sent_for_the_day_it_was_due(memory_db):
+    due = datetime(2024, 5, 10, 23, 58, tzinfo=BERLIN)
+    submitted, messages = enqueue_due(memory_db, "2024-05-09", due)
+    assert submitted == {'r'}
+    [doc] = messages
+    assert doc['_id'] == "reminder:r:2024-05-10"
+    assert doc['day'] == "2024-05-10"
+    assert doc['scheduled'].replace(tzinfo=timezone.utc) == due.astimezone(timezone.utc)
+
+
+def test_start_scheduler_fills_missing_timezones(memory_db):
+    async def start():
+        await memory_db.users.insert_one({'user_id': 2, 'tz': "Asia/Tokyo"})
+        await memory_db.reminders.insert_many([
+            {'_id': 'a', 'user_id': 1, 'time': "08:00", 'tz': "Europe/Berlin"},
+            # written by an older process, the user's other reminder has the timezone
+            {'_id': 'b', 'user_id': 1, 'time': "09:00"},
+            {'_id': 'c', 'user_id': 2, 'time': "10:00", 'tz': None},
+        ])
+        try:
+            await jobs.start_scheduler(None)
+            return {reminder_id: fire_at.tzinfo for reminder_id, fire_at in scheduler.upcoming(
+                datetime.now(timezone.utc) + timedelta(days=2))}
+        finally:
+            scheduler.load([], {})
+
+    assert asyncio.run(start()) == {'a': BERLIN, 'b': BERLIN, 'c': ZoneInfo("Asia/Tokyo")}
+
+
+def test_ai_metrics_only_count_approved_users(memory_db, monkeypatch):
+    from medbot import ai, metrics
+
+    monkeypatch.setattr(ai, 'APPROVED_USERS', ["alice"])
+    due = datetime(2024, 5, 10, 23, 58, tzinfo=BERLIN)
+    texts, fallbacks = metrics.ai_texts.total(), metrics.ai_fallbacks.total()
+    # user 1 has no profile, so no AI access: the default text is no fallback
+    enqueue_due(memory_db, None, due)
+    assert (metrics.ai_texts.total(), metrics.ai_fallbacks.total()) == (texts, fallbacks)
+    asyncio.run(memory_db.users.insert_one({'user_id': 1, 'username': "alice"}))
+    asyncio.run(memory_db.outbox.delete_many({}))
+    asyncio.run(memory_db.reminders.delete_many({}))
+    enqueue_due(memory_db, None, due)
+    assert (metrics.ai_texts.total(), metrics.ai_fallbacks.total()) == (texts + 1, fallbacks + 1)
@@ -0,0 +1,65 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+from medbot import leases
+from medbot.writebehind import writes
+
+
+def run(scenario):
+    async def main():
+        try:
+            return await scenario()
+        finally:
+            await writes.close()
+
+    return asyncio.run(main())
+
+
+def test_claim(memory_db):
+    later = datetime.now(timezone.utc) + timedelta(minutes=3)
+    earlier = datetime.now(timezone.utc) - timedelta(minutes=1)
+
+    async def scenario():
+        await memory_db.reminders.insert_many([
+            {'_id': 'free'},
+            {'_id': 'held', 'lease_owner': "other", 'lease_until': later},
+            {'_id': 'expired', 'lease_owner': "other", 'lease_until': earlier},
+            {'_id': 'ours', 'lease_owner': leases.WORKER_ID, 'lease_until': later},
+        ])
+        return await leases.claim(['free', 'held', 'expired', 'ours', 'deleted'])
+
+    claimed, held = run(scenario)
+    assert sorted(r['_id'] for r in claimed) == ['expired', 'free', 'ours']
+    assert all(r['lease_owner'] == leases.WORKER_ID for r in claimed)
+    # held by another worker until its lease ends, deleted ones are in neither
+    assert list(held) == ['held']
+    assert abs(held['held'] - later) < timedelta(seconds=1)
+
+
+def test_second_claim_is_held(memory_db, monkeypatch):
+    async def scenario():
+        await memory_db.reminders.insert_one({'_id': 'r'})
+        first, _ = await leases.claim(['r'])
+        monkeypatch.setattr(leases, 'WORKER_ID', "other")
+        second, held = await leases.claim(['r'])
+        return first, second, held
+
+    first, second, held = run(scenario)
+    assert [r['_id'] for r in first] == ['r']
+    assert second == [] and list(held) == ['r']
+
+
+def test_release_applies_the_update(memory_db):
+    async def scenario():
+        await memory_db.reminders.insert_one({'_id': 'r'})
+        await leases.claim(['r'])
+        leases.release('r', {'$set': {'confirmed': False}})
+        await writes.flush()
+        released = await memory_db.reminders.find_one({'_id': 'r'})
+        # claimable by anybody again
+        claimed, held = await leases.claim(['r'])
+        return released, claimed, held
+
+    released, claimed, held = run(scenario)
+    assert released == {'_id': 'r', 'confirmed': False}
+    assert [r['_id'] for r in claimed] == ['r'] and held == {}
@@ -0,0 +1,41 @@
+import json
+import logging
+
+from medbot.utils import JsonFormatter, RateLimitFilter
+
+
+def record(msg, created, level=logging.INFO, name="medbot.jobs", args=()):
+    r = logging.LogRecord(name, level, __file__, 1, msg, args, None)
+    r.created = created
+    return r
+
+
+def test_rate_limit_per_template():
+    limiter = RateLimitFilter(limit=2, interval=60)
+    passed = [limiter.filter(record("Sending reminder %s", 100 + i, args=(i,))) for i in range(5)]
+    assert passed == [True, True, False, False, False]
+    # another template has its own budget
+    assert limiter.filter(record("Sending reminders", 101))
+
+
+def test_next_interval_reports_the_suppressed():
+    limiter = RateLimitFilter(limit=1, interval=60)
+    assert limiter.filter(record("Sending reminder %s", 100, args=(1,)))
+    assert not limiter.filter(record("Sending reminder %s", 110, args=(2,)))
+    assert not limiter.filter(record("Sending reminder %s", 120, args=(3,)))
+    later = record("Sending reminder %s", 160, args=(4,))
+    assert limiter.filter(later)
+    assert later.getMessage() == "Sending reminder 4 (+2 similar suppressed)"
+
+
+def test_warnings_always_pass():
+    limiter = RateLimitFilter(limit=1, interval=60)
+    assert all(limiter.filter(record("Delivery failed", 100, level=logging.WARNING)) for _ in range(5))
+    assert all(limiter.filter(record("Delivery failed", 100, level=logging.ERROR)) for _ in range(5))
+
+
+def test_json_formatter():
+    entry = json.loads(JsonFormatter().format(record("Sent %d reminders", 0, args=(3,))))
+    assert entry['message'] == "Sent 3 reminders"
+    assert (entry['level'], entry['logger']) == ("INFO", "medbot.jobs")
+    assert entry['time'].startswith("1970-01-01T00:00:00.000")
@@ -0,0 +1,43 @@
+import asyncio
+
+from medbot import migrations
+
+
+def test_migrate(memory_db):
+    async def migrate():
+        await memory_db.users.insert_many([
+            {'user_id': 1, 'username': "alice", 'tz': None},
+            {'user_id': 1, 'username': None, 'tz': "Europe/Berlin"},
+            {'user_id': 2, 'username': "bob", 'tz': "Asia/Tokyo"},
+        ])
+        await memory_db.reminders.insert_many([
+            {'_id': 'a', 'user_id': 1, 'name': "pill", 'time': "08:00"},
+            {'_id': 'b', 'user_id': 2, 'name': "pill", 'time': "09:00", 'streak': 3},
+        ])
+        version = await migrations.migrate(memory_db)
+        return (
+            version,
+            await memory_db.users.find({}, {'_id': 0}).sort('user_id', 1).to_list(),
+            await memory_db.reminders.find({}).sort('_id', 1).to_list(),
+            await migrations.migrate(memory_db),
+        )
+
+    version, users, reminders, again = asyncio.run(migrate())
+    assert version == again == migrations.MIGRATIONS[-1][0]
+    # the duplicates were merged into one document, later non-null fields win
+    assert users == [
+        {'user_id': 1, 'username': "alice", 'tz': "Europe/Berlin"},
+        {'user_id': 2, 'username': "bob", 'tz': "Asia/Tokyo"},
+    ]
+    # backfilled and given their user's timezone
+    assert [(r['tz'], r['confirmed'], r['streak']) for r in reminders] == [
+        ("Europe/Berlin", False, 0), ("Asia/Tokyo", False, 3)
+    ]
+
+
+def test_unique_user_index(memory_db):
+    async def indexes():
+        await migrations.migrate(memory_db)
+        return await memory_db.users.index_information()
+
+    assert any(index.get('unique') and index['key'] == [('user_id', 1)] for index in asyncio.run(indexes()).values())
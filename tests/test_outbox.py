@@ -0,0 +1,142 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from telegram.error import Forbidden, NetworkError
+
+from medbot import outbox as outbox_module
+from medbot.outbox import DEAD, OUTBOX_BACKOFF, PENDING, SENDING, SENT, Outbox, backoff, message
+from medbot.writebehind import writes
+
+
+class Pool:
+    """ Delivery pool keeping the submitted messages """
+
+    def __init__(self):
+        self.messages = []
+
+    def submit(self, outgoing):
+        self.messages.append(outgoing)
+
+
+def aware(value: datetime) -> datetime:
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
+
+def run(memory_db, scenario):
+    box = Outbox(max_attempts=3)
+    box._pool = Pool()
+
+    async def main():
+        try:
+            return await scenario(box, box._pool)
+        finally:
+            await writes.close()
+
+    return asyncio.run(main())
+
+
+async def claim_and_submit(box):
+    docs = await box._claim(10)
+    for doc in docs:
+        box._submit(doc)
+    return docs
+
+
+def test_backoff():
+    assert OUTBOX_BACKOFF * 0.8 <= backoff(1) <= OUTBOX_BACKOFF * 1.2
+    assert OUTBOX_BACKOFF * 4 * 0.8 <= backoff(3) <= OUTBOX_BACKOFF * 4 * 1.2
+    assert backoff(100) <= outbox_module.OUTBOX_MAX_BACKOFF * 1.2
+
+
+def test_enqueue_is_idempotent(memory_db):
+    async def scenario(box, _pool):
+        first = await box.enqueue([message("a", 'note', 1, "hi"), message("b", 'note', 1, "hi")])
+        again = await box.enqueue([message("a", 'note', 1, "hi")])
+        return first, again, await memory_db.outbox.count_documents({})
+
+    assert run(memory_db, scenario) == (2, 0, 2)
+
+
+def test_failed_send_is_retried_with_backoff_then_dead_lettered(memory_db):
+    async def scenario(box, pool):
+        await box.enqueue([message("a", 'note', 1, "hi")])
+        [doc] = await claim_and_submit(box)
+        assert doc['status'] == SENDING
+        await pool.messages[-1].on_failed(NetworkError("timed out"))
+        await writes.flush()
+        retried = await memory_db.outbox.find_one({'_id': "a"})
+        # not ready again before its backoff
+        assert await box._claim(10) == []
+        states = [retried]
+        for _ in range(2):
+            await memory_db.outbox.update_one({'_id': "a"}, {'$set': {'next_attempt_at': datetime.now(timezone.utc)}})
+            await claim_and_submit(box)
+            await pool.messages[-1].on_failed(NetworkError("timed out"))
+            await writes.flush()
+            states.append(await memory_db.outbox.find_one({'_id': "a"}))
+        return states
+
+    retried, second, dead = run(memory_db, scenario)
+    assert (retried['status'], retried['attempts']) == (PENDING, 1)
+    assert 'lease_token' not in retried
+    delay = (aware(retried['next_attempt_at']) - datetime.now(timezone.utc)).total_seconds()
+    assert 0 < delay <= OUTBOX_BACKOFF * 1.2
+    assert (second['status'], second['attempts']) == (PENDING, 2)
+    assert (dead['status'], dead['attempts']) == (DEAD, 3)
+    assert dead['last_error'] == "NetworkError: timed out"
+
+
+def test_blocked_user_is_dead_lettered_at_once(memory_db):
+    async def scenario(box, pool):
+        await box.enqueue([message("a", 'note', 1, "hi")])
+        await claim_and_submit(box)
+        await pool.messages[-1].on_failed(Forbidden("bot was blocked by the user"))
+        await writes.flush()
+        return await memory_db.outbox.find_one({'_id': "a"})
+
+    doc = run(memory_db, scenario)
+    assert (doc['status'], doc['attempts']) == (DEAD, 1)
+
+
+def test_sent_message_runs_its_hook(memory_db):
+    hooked = []
+
+    async def scenario(box, pool):
+        box.on_sent('note', lambda doc, sent: hooked.append((doc['_id'], sent.message_id)))
+        await box.enqueue([message("a", 'note', 1, "hi")])
+        await claim_and_submit(box)
+        await pool.messages[-1].on_sent(SimpleNamespace(message_id=42))
+        await writes.flush()
+        return await memory_db.outbox.find_one({'_id': "a"}), box._in_flight
+
+    doc, in_flight = run(memory_db, scenario)
+    assert (doc['status'], doc['message_id']) == (SENT, 42)
+    assert hooked == [("a", 42)]
+    assert in_flight == {}
+
+
+def test_stop_hands_back_unsent_messages(memory_db):
+    async def scenario(box, _pool):
+        await box.enqueue([message("a", 'note', 1, "hi")])
+        await claim_and_submit(box)
+        await box.stop()
+        await writes.flush()
+        return await memory_db.outbox.find_one({'_id': "a"}), await box._claim(10)
+
+    doc, claimed = run(memory_db, scenario)
+    assert doc['status'] == PENDING and 'lease_owner' not in doc
+    # ready for the next process at once
+    assert [d['_id'] for d in claimed] == ["a"]
+
+
+def test_expired_lease_is_claimed_again(memory_db):
+    async def scenario(box, _pool):
+        await box.enqueue([message("a", 'note', 1, "hi")])
+        await box._claim(10)
+        # the worker holding it died
+        expired = datetime.now(timezone.utc) - timedelta(seconds=1)
+        await memory_db.outbox.update_one({'_id': "a"}, {'$set': {'lease_until': expired}})
+        return await Outbox()._claim(10)
+
+    assert [d['_id'] for d in run(memory_db, scenario)] == ["a"]
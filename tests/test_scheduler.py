@@ -0,0 +1,155 @@
+from datetime import date, datetime, time, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+from medbot.scheduler import ReminderScheduler, load_tz, next_fire_time
+
+BERLIN = ZoneInfo("Europe/Berlin")
+
+
+def utc(*args) -> datetime:
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+def test_next_fire_time_today():
+    # 09:00 in Berlin (CET) is 08:00 UTC
+    assert next_fire_time(time(9, 0), BERLIN, None, utc(2024, 1, 10, 6, 0)) == utc(2024, 1, 10, 8, 0)
+
+
+def test_next_fire_time_overdue_lies_in_the_past():
+    now = utc(2024, 1, 10, 12, 0)
+    assert next_fire_time(time(9, 0), BERLIN, date(2024, 1, 9), now) == utc(2024, 1, 10, 8, 0)
+
+
+def test_next_fire_time_sent_today_is_due_tomorrow():
+    assert next_fire_time(time(9, 0), BERLIN, date(2024, 1, 10), utc(2024, 1, 10, 12, 0)) == utc(2024, 1, 11, 8, 0)
+
+
+def test_next_fire_time_uses_the_local_date():
+    # already the 11th in Tokyo
+    tokyo = ZoneInfo("Asia/Tokyo")
+    now = utc(2024, 1, 10, 23, 30)
+    assert next_fire_time(time(9, 0), tokyo, date(2024, 1, 11), now) == utc(2024, 1, 12, 0, 0)
+
+
+def test_next_fire_time_in_spring_forward_gap():
+    # 02:30 does not exist on 2024-03-31 in Berlin, it fires at 03:30 CEST
+    now = utc(2024, 3, 31, 0, 0)
+    assert next_fire_time(time(2, 30), BERLIN, None, now) == utc(2024, 3, 31, 1, 30)
+
+
+def test_next_fire_time_in_fall_back_fold():
+    # 02:30 happens twice on 2024-10-27 in Berlin, it fires on the first (CEST)
+    now = utc(2024, 10, 26, 22, 0)
+    assert next_fire_time(time(2, 30), BERLIN, None, now) == utc(2024, 10, 27, 0, 30)
+
+
+def test_next_fire_time_across_dst_change():
+    # sent on the day before the change, due at the same wall time with the new offset
+    now = utc(2024, 3, 30, 10, 0)
+    assert next_fire_time(time(8, 0), BERLIN, date(2024, 3, 30), now) == utc(2024, 3, 31, 6, 0)
+
+
+def test_load_tz():
+    assert load_tz("Europe/Berlin") == BERLIN
+    assert load_tz(None) is None
+    assert load_tz("Not/AZone") is None
+
+
+def reminder(reminder_id, user_id=1, at="08:00", last_sent_date=None):
+    return {'_id': reminder_id, 'user_id': user_id, 'time': at, 'last_sent_date': last_sent_date}
+
+
+def soon() -> datetime:
+    # every reminder is due within a day
+    return datetime.now(timezone.utc) + timedelta(days=2)
+
+
+def test_add_and_pop_due_in_fire_order():
+    scheduler = ReminderScheduler()
+    scheduler.add(reminder('late', at="10:00"), "UTC")
+    scheduler.add(reminder('early', at="09:00"), "UTC")
+    assert len(scheduler) == 2 and 'early' in scheduler
+    fire_at = next_fire_time(time(9, 0), timezone.utc, None)
+    assert scheduler.next_fire() == fire_at
+    assert list(scheduler.pop_due(fire_at - timedelta(seconds=1))) == []
+    assert list(scheduler.pop_due(fire_at)) == ['early']
+    assert list(scheduler.pop_due(soon())) == ['late']
+    # popped reminders are in flight until marked sent or retried
+    assert list(scheduler.pop_due(soon())) == []
+
+
+def test_mark_sent_schedules_the_next_day():
+    scheduler = ReminderScheduler()
+    scheduler.add(reminder('r'), "UTC")
+    assert list(scheduler.pop_due(soon())) == ['r']
+    today = datetime.now(timezone.utc).date()
+    scheduler.mark_sent('r', today)
+    assert scheduler.next_fire() == datetime.combine(today + timedelta(days=1), time(8, 0), tzinfo=timezone.utc)
+
+
+def test_release_retries_unfinished_reminders():
+    scheduler = ReminderScheduler()
+    scheduler.add(reminder('r'), "UTC")
+    assert list(scheduler.pop_due(soon())) == ['r']
+    scheduler.release(['r'])
+    assert list(scheduler.pop_due(soon())) == ['r']
+
+
+def test_retried_reminder_keeps_its_due_instant():
+    scheduler = ReminderScheduler()
+    scheduler.add(reminder('r'), "UTC")
+    fire_at = next_fire_time(time(8, 0), timezone.utc, None)
+    assert scheduler.pop_due(soon()) == {'r': fire_at}
+    # e.g. held by another process past midnight
+    scheduler.retry('r', timedelta(days=3))
+    assert scheduler.pop_due(soon()) == {}
+    assert scheduler.pop_due(soon() + timedelta(days=2)) == {'r': fire_at}
+
+
+def test_remove_and_remove_user():
+    scheduler = ReminderScheduler()
+    scheduler.add(reminder('a', user_id=1), "UTC")
+    scheduler.add(reminder('b', user_id=1), "UTC")
+    scheduler.add(reminder('c', user_id=2), "UTC")
+    scheduler.remove('a')
+    assert 'a' not in scheduler
+    scheduler.remove_user(1)
+    assert len(scheduler) == 1
+    assert scheduler.user_of('c') == 2
+    assert list(scheduler.pop_due(soon())) == ['c']
+
+
+def test_changed_reminder_replaces_the_old_one():
+    scheduler = ReminderScheduler()
+    scheduler.add(reminder('r', at="09:00"), "UTC")
+    scheduler.add(reminder('r', at="10:00"))
+    assert len(scheduler) == 1
+    assert scheduler.next_fire() == next_fire_time(time(10, 0), timezone.utc, None)
+
+
+def test_set_timezone():
+    scheduler = ReminderScheduler()
+    scheduler.add(reminder('r'))
+    # no timezone, nothing to deliver
+    assert scheduler.next_fire() is None
+    scheduler.set_timezone(1, "Europe/Berlin")
+    assert scheduler.next_fire() == next_fire_time(time(8, 0), BERLIN, None)
+    scheduler.set_timezone(1, "Asia/Tokyo")
+    assert scheduler.next_fire() == next_fire_time(time(8, 0), ZoneInfo("Asia/Tokyo"), None)
+    scheduler.set_timezone(1, None)
+    assert scheduler.next_fire() is None
+    assert list(scheduler.pop_due(soon())) == []
+
+
+def test_upcoming():
+    scheduler = ReminderScheduler()
+    scheduler.add(reminder('a', at="08:00"), "Europe/Berlin")
+    scheduler.add(reminder('b', user_id=2, at="09:00"), "UTC")
+    fire_a = next_fire_time(time(8, 0), BERLIN, None)
+    upcoming = dict(scheduler.upcoming(soon()))
+    assert set(upcoming) == {'a', 'b'}
+    # local fire time in the user's timezone
+    assert upcoming['a'] == fire_a.astimezone(BERLIN)
+    assert upcoming['a'].time() == time(8, 0)
+    assert dict(scheduler.upcoming(fire_a)).keys() >= {'a'}
+    assert scheduler.upcoming(fire_a - timedelta(days=3)) == []
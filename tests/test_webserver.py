@@ -0,0 +1,43 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import tornado.web
+from tornado.testing import AsyncHTTPTestCase
+
+from medbot.webserver import HealthHandler, WebhookHandler
+
+SECRET = "s3cret"
+
+
+class WebhookTest(AsyncHTTPTestCase):
+    def get_app(self):
+        self.bot_app = SimpleNamespace(bot=None, update_queue=asyncio.Queue())
+        return tornado.web.Application([
+            (r"/health", HealthHandler),
+            (r"/telegram", WebhookHandler, {'bot_app': self.bot_app, 'secret_token': SECRET}),
+            (r"/open", WebhookHandler, {'bot_app': self.bot_app, 'secret_token': ""}),
+        ])
+
+    def post(self, path, secret=None, body=None):
+        headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret is not None else {}
+        return self.fetch(path, method="POST", headers=headers, body=body or json.dumps({"update_id": 1}))
+
+    def test_update_with_the_secret_is_queued(self):
+        assert self.post("/telegram", SECRET).code == 200
+        assert self.bot_app.update_queue.get_nowait().update_id == 1
+
+    def test_update_without_the_secret_is_rejected(self):
+        assert self.post("/telegram").code == 403
+        assert self.post("/telegram", "guess").code == 403
+        assert self.bot_app.update_queue.empty()
+
+    def test_route_without_a_secret_rejects_everything(self):
+        assert self.post("/open").code == 403
+        assert self.post("/open", "").code == 403
+
+    def test_invalid_payload(self):
+        assert self.post("/telegram", SECRET, body="not json").code == 400
+
+    def test_health(self):
+        assert json.loads(self.fetch("/health").body) == {"status": "ok"}
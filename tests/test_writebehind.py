@@ -0,0 +1,63 @@
+import asyncio
+
+from medbot.writebehind import WriteBehind
+
+
+def test_writes_to_one_document_keep_their_order(memory_db, monkeypatch):
+    from memory_mongo import AsyncCollection
+
+    calls = []
+    bulk_write = AsyncCollection.bulk_write
+
+    async def recorded(self, requests, ordered=True):
+        calls.append([op._filter['_id'] for op in requests])
+        return await bulk_write(self, requests, ordered)
+
+    monkeypatch.setattr(AsyncCollection, 'bulk_write', recorded)
+
+    async def write():
+        writes = WriteBehind(interval=60)
+        await memory_db.reminders.insert_many([{'_id': 'a', 'n': 0}, {'_id': 'b', 'n': 0}])
+        writes.update('reminders', {'_id': 'a'}, {'$set': {'n': 1}})
+        writes.update('reminders', {'_id': 'b'}, {'$set': {'n': 1}})
+        writes.update('reminders', {'_id': 'a'}, {'$inc': {'n': 10}})
+        writes.update('reminders', {'_id': 'a'}, {'$set': {'n': 5}})
+        assert len(writes) == 4
+        await writes.flush()
+        assert len(writes) == 0
+        return {r['_id']: r['n'] async for r in memory_db.reminders.find({})}
+
+    assert asyncio.run(write()) == {'a': 5, 'b': 1}
+    # each unordered bulk_write holds at most one write per document
+    assert calls == [['a', 'b'], ['a'], ['a']]
+
+
+def test_flush_when_full(memory_db):
+    async def write():
+        writes = WriteBehind(max_size=2, interval=60)
+        writes.update('reminders', {'_id': 'a'}, {'$set': {'n': 1}}, upsert=True)
+        writes.update('reminders', {'_id': 'b'}, {'$set': {'n': 1}}, upsert=True)
+        # the flush is scheduled on the loop
+        await asyncio.sleep(0.01)
+        assert len(writes) == 0
+        return await memory_db.reminders.count_documents({})
+
+    assert asyncio.run(write()) == 2
+
+
+def test_writes_go_to_the_active_bots_database(memory_db):
+    from medbot import bots
+
+    async def write():
+        writes = WriteBehind(interval=60)
+        other = bots.BotConfig(name="other", token="", environment="other")
+        with bots.use(other):
+            writes.update('reminders', {'_id': 'a'}, {'$set': {'n': 1}}, upsert=True)
+        writes.update('reminders', {'_id': 'a'}, {'$set': {'n': 2}}, upsert=True)
+        await writes.flush()
+        with bots.use(other):
+            theirs = await memory_db.reminders.find_one({'_id': 'a'})
+        ours = await memory_db.reminders.find_one({'_id': 'a'})
+        return theirs['n'], ours['n']
+
+    assert asyncio.run(write()) == (1, 2)